@@ -3,10 +3,14 @@ import sys, os
 import sqlite3
 import json
 import configparser
+import threading
 from datetime import datetime, time, timedelta, timezone
-from .libellen_xls import prune_old_data as prune_xls, ensure as ensure_xls, update_bap as update_bap_xls, update_ivar as update_ivar_xls, set_config as set_config_xls
-from .libellen_sql import prune_old_data as prune_sql, ensure as ensure_sql, update_bap as update_bap_sql, update_ivar as update_ivar_sql, set_config as set_config_sql
 from .libellen_core import Config, Candidate, GImage
+from .libellen_event import Event
+from . import libellen_event
+from . import libellen_images
+from . import libellen_dedup
+from . import libellen_stream
 
 STORE_XLS = "XLS"
 STORE_SQL = "SQL"
@@ -24,18 +28,35 @@ ensure = None
 update_bap = None
 update_ivar = None
 set_config = None
+maintenance_pending = None
 
-def apply_config(conf: Config):
-    """ applies the supplied conf object to the server instance """
-    global CONFIG
-    CONFIG = conf
-    SetActiveStore()
-    InitBackingStore()
+# serializes access to the backing store between request threads and background maintenance
+_STORE_LOCK = threading.RLock()
+
+def apply_config(conf: Config, prune_now: bool = True):
+    """ applies the supplied conf object to the server instance, without stopping incoming events.
+    The new store is prepared first, and only swapped in once in-flight writes have finished.
+    If prune_now is False, the prune is skipped and should be run later via run_maintenance """
+    store = _load_store(conf.KIND) # raises AttributeError for a bad kind, before anything has changed
+    # a different kind of store isn't in use yet, so it can be warmed up off to the side while events keep going to the current one
+    off_to_side = CONFIG is None or conf.KIND != CONFIG.KIND
+    if off_to_side:
+        store["set_config"](conf)
+        store["ensure"]()
+    with _STORE_LOCK: # waits for in-flight writes, and holds back new ones until the switch is complete
+        if not off_to_side:
+            store["set_config"](conf)
+            store["ensure"]()
+        libellen_images.set_config(conf)
+        libellen_dedup.set_config(conf)
+        _activate_store(conf, store)
+    if prune_now:
+        run_maintenance()
     return
 
 def read_config() -> Config:
-    """ reads the config file at the regular path, returns None if no config is found """
-    global CONFIG
+    """ reads the config file at the regular path, returns None if no config is found.
+    The config isn't used until it is passed to apply_config """
     conf = configparser.ConfigParser()
     if not conf.read("./config.ini"):
         return None
@@ -51,14 +72,25 @@ def read_config() -> Config:
         OUTPUT_DIR = str(conf["SAVE"]["OutputDirectory"])
         KIND = str(conf["SAVE"]["Kind"])
         TIMEZONE = str(conf["SAVE"]["Timezone"])
+        # dedup settings were added later, so older config files may not have them
+        DEDUP_IMAGES = json.loads(conf["SAVE"].get("DedupImages", "False").lower())
+        DEDUP_THRESHOLD = int(conf["SAVE"].get("DedupThreshold", "6"))
+        DEDUP_WINDOW = int(conf["SAVE"].get("DedupWindowSeconds", "60"))
 
         PORT = int(conf["SERVER"]["Port"])
+        DEBUG_PROFILER = json.loads(conf.get("DEBUG", "Profiler", fallback="False").lower())
+        SQL_PROFILE = str(conf.get("SQL", "Profile", fallback="durable")).lower()
+        from . import libellen_sql # only for the profile names, the SQL store itself is still loaded on demand
+        if SQL_PROFILE not in libellen_sql.PROFILES:
+            print(f"WARNING: unknown [SQL] Profile '{SQL_PROFILE}' in config.ini, using durable instead. Accepted profiles: {', '.join(libellen_sql.PROFILES)}")
+            SQL_PROFILE = libellen_sql.PROFILE_DURABLE
 
-        CONFIG = Config(STORE_FULL_JSON, STORE_IMAGE,
+        config = Config(STORE_FULL_JSON, STORE_IMAGE,
         STORE_IMAGE_KIND, MAX_DB_SIZE, MAX_RECORD_COUNT,
         MAX_KEEP_DAYS, DATA_DIR, OUTPUT_DIR, KIND, PORT,
-        TIMEZONE)
-        return CONFIG
+        TIMEZONE, DEDUP_IMAGES, DEDUP_THRESHOLD, DEDUP_WINDOW,
+        DEBUG_PROFILER, SQL_PROFILE)
+        return config
     except:
         return None
 
@@ -77,17 +109,27 @@ def write_default_config() -> bool:
         "DataDirectory": "./data",
         "OutputDirectory": "./",
         "Kind": "XLS",
-        "Timezone": "Local"
+        "Timezone": "Local",
+        "DedupImages": "False",
+        "DedupThreshold": "6",
+        "DedupWindowSeconds": "60",
     }
     conf["SERVER"] = {
         "Port": "5000",
     }
+    conf["SQL"] = {
+        "Profile": "durable",
+    }
+    conf["DEBUG"] = {
+        "Profiler": "False",
+    }
     with open("./config.ini", 'w') as f:
         conf.write(f)
     return True
 
-def write_custom_config(config: Config) -> bool:
+def write_custom_config(config: Config, prune_now: bool = True) -> bool:
     """ Given a new config object, writes it to disk and reloads it via apply_config """
+    _load_store(config.KIND) # raises AttributeError for a bad kind, before the config file is overwritten
     conf = configparser.ConfigParser()
     conf["MAINTENANCE"] = {
         "MaxKeepDays": config.MAX_KEEP_DAYS,
@@ -101,87 +143,123 @@ def write_custom_config(config: Config) -> bool:
         "DataDirectory": config.SAVE_PATH,
         "OutputDirectory": config.OUTPUT_PATH,
         "Kind": config.KIND,
-        "Timezone": config.TIMEZONE
+        "Timezone": config.TIMEZONE,
+        "DedupImages": config.DEDUP_IMAGES,
+        "DedupThreshold": config.DEDUP_THRESHOLD,
+        "DedupWindowSeconds": config.DEDUP_WINDOW,
     }
     conf["SERVER"] = {
         "Port": config.PORT,
     }
+    conf["SQL"] = {
+        "Profile": config.SQL_PROFILE,
+    }
+    conf["DEBUG"] = {
+        "Profiler": config.DEBUG_PROFILER,
+    }
     with open("./config.ini", 'w') as f:
         conf.write(f)
-    apply_config(config)
+    apply_config(config, prune_now)
     return True
 
 
-def InitBackingStore():
+def InitBackingStore(prune_now: bool = True):
     """ Initializes the backing store and ensures it is in a writable state """
     if ensure is not None:
-        ensure() # dynamic dispatch to the true storage's ensure method
-        prune()
+        with _STORE_LOCK:
+            ensure() # dynamic dispatch to the true storage's ensure method
+        if prune_now:
+            run_maintenance()
     else:
         raise Exception("No Active Store was set. Call SetActiveStore before continuing")
     return
 
-def SetActiveStore():
-    """ Sets the backing store to use. Accepted values are either XLS or SQL """
-    global prune, ensure, update_bap, update_ivar
-    if CONFIG.KIND == STORE_XLS:
-        prune = prune_xls
-        ensure = ensure_xls
-        update_bap = update_bap_xls
-        update_ivar = update_ivar_xls
-        set_config = set_config_xls
-    elif CONFIG.KIND == STORE_SQL:
-        prune = prune_sql
-        ensure = ensure_sql
-        update_bap = update_bap_sql
-        update_ivar = update_ivar_sql
-        set_config = set_config_sql
+def _load_store(kind: str) -> Dict[str, object]:
+    """ returns the store functions of the backend for kind. Accepted values are either XLS or SQL.
+    Backends are imported here rather than at module load, so that openpyxl and Pillow are only loaded when XLS is chosen """
+    if kind == STORE_XLS:
+        from . import libellen_xls as backend
+    elif kind == STORE_SQL:
+        from . import libellen_sql as backend
     else:
         raise AttributeError("Backing store must be oneof 'XLS', 'SQL'")
-    set_config(CONFIG)
+    return {
+        "prune": backend.prune_old_data,
+        "ensure": backend.ensure,
+        "update_bap": backend.update_bap,
+        "update_ivar": backend.update_ivar,
+        "set_config": backend.set_config,
+        "maintenance_pending": backend.maintenance_pending,
+    }
+
+def _activate_store(conf: Config, store: Dict[str, object]):
+    """ makes conf and store the active ones. Callers must hold _STORE_LOCK, so that writers never see half of a switch """
+    global CONFIG, prune, ensure, update_bap, update_ivar, set_config, maintenance_pending
+    prune = store["prune"]
+    ensure = store["ensure"]
+    update_bap = store["update_bap"]
+    update_ivar = store["update_ivar"]
+    set_config = store["set_config"]
+    maintenance_pending = store["maintenance_pending"]
+    CONFIG = conf
     return
 
+def SetActiveStore():
+    """ Sets the backing store to use, according to CONFIG.KIND. Accepted values are either XLS or SQL """
+    store = _load_store(CONFIG.KIND)
+    store["set_config"](CONFIG)
+    with _STORE_LOCK:
+        _activate_store(CONFIG, store)
+    return
+
+def run_maintenance():
+    """ prunes the active backing store while holding the store lock, so that it does not interleave with incoming writes """
+    with _STORE_LOCK:
+        return prune()
+
+def decode_event(jobj: dict) -> Event:
+    """ validates and extracts a Gorilla event according to the current config. Raises ValueError if it isn't a valid Gorilla event """
+    return libellen_event.decode_event(jobj, CONFIG)
+
 def receive_json(jobj: dict) -> int:
     """ given an ivar event, updates the data storage with the received data, according to the storage preferences.
     returns 0 for success, or throws an error otherwise
     """
     try:
-        ensure() # it is possible that the output file was moved or deleted during server execution. Put it back 
+        event = decode_event(jobj)
+    except ValueError as e:
+        raise RuntimeError("Failed to store Gorilla data", e)
+    return receive_event(event, jobj)
+
+def receive_event(event: Event, jobj: dict) -> int:
+    """ given an ivar event already decoded by decode_event, updates the data storage with it, according to the storage preferences.
+    jobj is the original json, which is stored if StoreFullJson is on. returns 0 for success, or throws an error otherwise
+    """
+    config = CONFIG # read once, a reload may swap CONFIG while this event is being stored
+    try:
+        with _STORE_LOCK:
+            ensure() # it is possible that the output file was moved or deleted during server execution. Put it back 
     except Exception as e:
         raise FileNotFoundError("Failed to re-create storage file", e)
     try:
-        id = jobj["id"]
-        timestamp = datetime.strptime(jobj["common"]["time"], "%Y-%m-%dT%H:%M:%S.%fZ")
-        if CONFIG.TIMEZONE.lower() == TZ_LOCAL.lower():
-            timestamp = timestamp.replace(tzinfo=timezone.utc).astimezone(tz=None).replace(tzinfo=None)
-        eventType = jobj["common"]["type"]
-        img: GImage = None
-        candidates: List[Candidate] = []
-        if CONFIG.STORE_IMAGE and jobj["images"]:
-            # nf todo - what about a scene with multiple people, how does Gorilla send that?
-            for iobj in jobj["images"]:
-                if CONFIG.STORE_IMAGE_KIND in iobj["type"]:
-                    if "dataBase64" in iobj and iobj["dataBase64"]:
-                        img = GImage(iobj["dataType"], iobj["dataFileName"], iobj["dataBase64"])
-                    else:
-                        print(f"Image field was unavailable for gorilla event id: {id}")
-                        img = None
-        if "fr" in jobj and jobj["fr"]:
-            if jobj["fr"]["candidates"]:
-                for c in jobj["fr"]["candidates"]:
-                    score = c["similiarityScore"]
-                    try:
-                        score = float(score) # scores are a number in range of [0,1]
-                    except:
-                        print("Failed to get score for candidate, likely was an error string, and not a float")
-                        score = None # failed to convert to a number because what was received was likely an error string. Set default to None
-                    cand = Candidate(c["id"], c["displayName"], score)
-                    candidates.append(cand)
-        else:
-            print(f"fr data field was unavailable for gorilla event id: {id}")
-        candidate: Candidate = candidates[0] if candidates else None
-        update_bap(candidates)
-        update_ivar(id, timestamp, eventType, img, candidate, json.dumps(jobj) if CONFIG.STORE_FULL_JSON else None)
+        img = event.Image
+        candidate = event.Candidate
+        if img is not None:
+            # rows only reference the image by its content hash. The image stays pinned until its row is written,
+            # so that a prune in between can't garbage collect it
+            if config.DEDUP_IMAGES:
+                libellen_dedup.dedup_and_store(img, candidate.Id if candidate else None)
+            else:
+                libellen_images.store_image(img, pin_image=True)
+        try:
+            with _STORE_LOCK:
+                update_bap(event.Candidates)
+                update_ivar(event.Id, event.Timestamp, event.EventType, img, candidate, json.dumps(jobj) if config.STORE_FULL_JSON else None)
+                # published under the lock once the write has committed, so subscribers see events in storage order
+                libellen_stream.publish(event.Id, event.Timestamp, event.EventType, img, candidate)
+        finally:
+            if img is not None and img.Hash:
+                libellen_images.unpin(img.Hash)
         return 0
     except Exception as e:
         raise RuntimeError("Failed to store Gorilla data", e)
@@ -1,12 +1,16 @@
 import base64
 import os
-from PIL import Image  
 
 class Config():
     """ Configuration object that dictates the details for how the saved IVAR data is stored """
+    __slots__ = ("STORE_FULL_JSON", "STORE_IMAGE", "STORE_IMAGE_KIND", "MAX_SIZE", "MAX_RECORD_COUNT", "MAX_KEEP_DAYS",
+                "SAVE_PATH", "OUTPUT_PATH", "KIND", "PORT", "TIMEZONE", "DEDUP_IMAGES", "DEDUP_THRESHOLD", "DEDUP_WINDOW",
+                "DEBUG_PROFILER", "SQL_PROFILE")
     def __init__(self, store_full_json: bool, store_image: bool, store_image_kind: str,
                 max_size: int, max_records: int, max_days: int, save_path: str, out_dir: str,
-                kind: str, port: int, timezone: str):
+                kind: str, port: int, timezone: str,
+                dedup_images: bool = False, dedup_threshold: int = 6, dedup_window: int = 60,
+                debug_profiler: bool = False, sql_profile: str = "durable"):
         self.STORE_FULL_JSON: bool = store_full_json
         self.STORE_IMAGE: bool = store_image
         self.STORE_IMAGE_KIND: str = store_image_kind
@@ -18,10 +22,20 @@ class Config():
         self.KIND: str = kind
         self.PORT: int = port
         self.TIMEZONE: str = timezone
+        self.DEDUP_IMAGES: bool = dedup_images
+        self.DEDUP_THRESHOLD: int = dedup_threshold # images whose perceptual hashes differ by fewer bits than this are duplicates
+        self.DEDUP_WINDOW: int = dedup_window # seconds that an image is remembered for when looking for duplicates
+        self.DEBUG_PROFILER: bool = debug_profiler # whether the /debug/profile endpoint is available
+        self.SQL_PROFILE: str = sql_profile # one of durable, balanced or fast, see libellen_sql.PROFILES
+
+    def to_dict(self) -> dict:
+        """ returns the config options as a dict, for display """
+        return {k: getattr(self, k) for k in self.__slots__}
 
 
 class Candidate():
     """ simplified Gorilla candidate containing only its gorilla id, display name, and score """
+    __slots__ = ("Id", "DisplayName", "SimiliarityScore")
     def __init__(self, id: int, display: str, score: float):
         self.Id: int = id
         self.DisplayName: str = display
@@ -29,10 +43,13 @@ class Candidate():
 
 class GImage():
     """ simplified Gorilla image data """
-    def __init__(self, ext: str, fname: str, b64: str):
+    __slots__ = ("Ext", "FName", "B64", "Hash", "Reused")
+    def __init__(self, ext: str, fname: str, b64: str, hash: str = None):
         self.Ext: str = ext
         self.FName: str = fname
         self.B64: str = b64
+        self.Hash: str = hash # content hash in the image store, assigned once the image has been stored
+        self.Reused: bool = False # True if this image was a near-duplicate, and Hash points to an earlier image
 
 
 def dump_b64_img_to_file(b64: str, path: str):
@@ -45,6 +62,7 @@ def dump_b64_img_to_file(b64: str, path: str):
 
 def resize_image(path: str, square_size_px: int):
     """ resizes the image at path to be a square image of pixel dimensions square_size_px """
+    from PIL import Image # imported lazily, Pillow is only needed by the XLS store
     im: Image = Image.open(path)
     im = im.resize((square_size_px, square_size_px))
     im.save(path)
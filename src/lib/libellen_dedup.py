@@ -0,0 +1,118 @@
+from typing import List, Set, Dict, Tuple, Optional
+import sys, os
+import io
+import base64
+import threading
+import time
+from collections import deque
+from .libellen_core import Config, GImage
+from . import libellen_images
+
+## Near-duplicate image suppression
+# Someone standing in front of a camera produces many almost identical FACE events.
+# For each image we compute a 64 bit difference hash (dHash), and compare it against the recent hashes
+# seen for the same person. If one is close enough, the event reuses the earlier image instead of storing a new one.
+_HASH_SIZE = 8 # dHash is computed over an (_HASH_SIZE+1) x _HASH_SIZE grayscale thumbnail, giving _HASH_SIZE^2 bits
+_MAX_PER_PERSON = 16 # only the most recent hashes per person are compared against
+_MAX_PEOPLE = 1024 # expired entries are swept once the index tracks more people than this
+
+_CONFIG: Config = None
+_LOCK = threading.Lock()
+# person id -> deque of (monotonic time seen, perceptual hash, image store hash)
+_INDEX: Dict[int, deque] = {}
+_STATS: Dict[str, int] = {
+    "images_checked": 0,
+    "images_reused": 0,
+    "images_stored": 0,
+    "bytes_saved": 0,
+    "hash_failures": 0,
+}
+
+def set_config(config: Config):
+    global _CONFIG
+    _CONFIG = config
+    with _LOCK:
+        _INDEX.clear() # thresholds or windows may have changed, start over
+    return
+
+def perceptual_hash(data: bytes) -> int:
+    """ computes the 64 bit difference hash of the image bytes. Similar looking images have hashes with a small hamming distance """
+    from PIL import Image # imported lazily, Pillow is only needed when dedup is enabled
+    with Image.open(io.BytesIO(data)) as im:
+        im = im.convert("L").resize((_HASH_SIZE + 1, _HASH_SIZE))
+        px = list(im.getdata())
+    h = 0
+    for row in range(_HASH_SIZE):
+        for col in range(_HASH_SIZE):
+            left = px[row * (_HASH_SIZE + 1) + col]
+            right = px[row * (_HASH_SIZE + 1) + col + 1]
+            h = (h << 1) | (1 if left > right else 0)
+    return h
+
+def hamming_distance(a: int, b: int) -> int:
+    """ number of differing bits between two hashes """
+    return bin(a ^ b).count("1")
+
+def _sweep_expired(now: float):
+    """ drops every person whose most recent hash is outside the window. Must be called with _LOCK held """
+    for pid in [pid for pid, entries in _INDEX.items() if not entries or now - entries[-1][0] > _CONFIG.DEDUP_WINDOW]:
+        del _INDEX[pid]
+    return
+
+def dedup_and_store(img: GImage, person_id: int) -> bool:
+    """ stores img in the image store, unless a near-identical image was stored for the same person within the window,
+    in which case img.Hash is pointed at that earlier image instead.
+    Returns True if an earlier image was reused. Images of unrecognised people (person_id None) are always stored,
+    as two different unknown faces may look alike. Either way img.Hash is pinned, and must be unpinned once the row is written """
+    data = base64.b64decode(img.B64)
+    if person_id is None:
+        img.Hash = libellen_images.store_bytes(data, img.Ext, pin_image=True)
+        with _LOCK:
+            _STATS["images_stored"] += 1
+        return False
+    try:
+        phash = perceptual_hash(data)
+    except Exception as e:
+        print(f"Failed to compute perceptual hash, storing image as-is: {e}")
+        with _LOCK:
+            _STATS["hash_failures"] += 1
+        phash = None
+    now = time.monotonic()
+    match = None
+    if phash is not None:
+        with _LOCK:
+            _STATS["images_checked"] += 1
+            entries = _INDEX.get(person_id)
+            if entries:
+                while entries and now - entries[0][0] > _CONFIG.DEDUP_WINDOW:
+                    entries.popleft()
+                for _, earlier, hash in reversed(entries):
+                    if hamming_distance(phash, earlier) < _CONFIG.DEDUP_THRESHOLD:
+                        match = hash
+                        break
+    if match is not None:
+        libellen_images.pin(match)
+        if libellen_images.find_image(match) is not None: # the earlier image may have been pruned since
+            img.Hash = match
+            img.Reused = True
+            with _LOCK:
+                _STATS["images_reused"] += 1
+                _STATS["bytes_saved"] += len(data)
+            return True
+        libellen_images.unpin(match)
+    hash = libellen_images.store_bytes(data, img.Ext, pin_image=True)
+    img.Hash = hash
+    with _LOCK:
+        _STATS["images_stored"] += 1
+        if phash is not None:
+            if person_id not in _INDEX and len(_INDEX) >= _MAX_PEOPLE:
+                _sweep_expired(now)
+            _INDEX.setdefault(person_id, deque(maxlen=_MAX_PER_PERSON)).append((now, phash, hash))
+    return False
+
+def get_stats() -> Dict[str, int]:
+    """ returns a copy of the dedup counters, including how much storage has been saved """
+    with _LOCK:
+        stats = dict(_STATS)
+        stats["people_tracked"] = len(_INDEX)
+    return stats
@@ -0,0 +1,194 @@
+from typing import List, Set, Dict, Tuple, Optional
+import sys, os
+import json
+from datetime import datetime, timedelta, timezone
+from .libellen_core import Config, Candidate, GImage
+
+## Single pass decoder for Gorilla IVAR events
+# Validates a posted event and extracts everything Ellen stores from it in one walk over the json,
+# instead of validating it in the server and then indexing the same dicts again while storing it.
+
+class Event():
+    """ a decoded Gorilla event, holding only the fields that Ellen stores """
+    __slots__ = ("Id", "Timestamp", "EventType", "Image", "Candidates")
+    def __init__(self, id: str, timestamp: datetime, eventType: str, img: GImage, candidates: List[Candidate]):
+        self.Id: str = id
+        self.Timestamp: datetime = timestamp
+        self.EventType: str = eventType
+        self.Image: GImage = img
+        self.Candidates: List[Candidate] = candidates
+
+    @property
+    def Candidate(self) -> Candidate:
+        """ the best matching candidate, which is the one stored alongside the event """
+        return self.Candidates[0] if self.Candidates else None
+
+
+# Local time conversion. The UTC offset only changes at DST transitions, which happen on a quarter hour,
+# so the offset is looked up once per quarter hour of UTC time and reused for every event inside it.
+# (quarter hour key, offset), kept as one tuple so request threads always see a matching pair
+_OFFSET_CACHE: Tuple[tuple, timedelta] = (None, None)
+
+def _local_offset(key: tuple, utc: datetime) -> timedelta:
+    global _OFFSET_CACHE
+    cached_key, offset = _OFFSET_CACHE
+    if key != cached_key:
+        offset = utc.replace(tzinfo=timezone.utc).astimezone(tz=None).utcoffset()
+        _OFFSET_CACHE = (key, offset)
+    return offset
+
+def parse_time(s: str, local: bool) -> datetime:
+    """ parses a Gorilla timestamp, like 2020-08-01T10:00:00.123Z, which is always UTC.
+    Returns a naive datetime in either UTC or, if local is True, the local time of this computer.
+    Raises ValueError if s isn't in that format """
+    if not isinstance(s, str) or len(s) < 20 or s[-1] != "Z" or s[4] != "-" or s[7] != "-" or s[10] != "T" or s[13] != ":" or s[16] != ":":
+        raise ValueError(f"Unrecognized timestamp: {s}")
+    micro = 0
+    if len(s) > 20:
+        if s[19] != ".":
+            raise ValueError(f"Unrecognized timestamp: {s}")
+        frac = s[20:-1]
+        if not frac.isdigit():
+            raise ValueError(f"Unrecognized timestamp: {s}")
+        micro = int(frac[:6].ljust(6, "0"))
+    year, month, day = int(s[0:4]), int(s[5:7]), int(s[8:10])
+    hour, minute, second = int(s[11:13]), int(s[14:16]), int(s[17:19])
+    dt = datetime(year, month, day, hour, minute, second, micro)
+    if local:
+        dt = dt + _local_offset((year, month, day, hour, minute // 15), dt)
+    return dt
+
+def _fail(msg: str):
+    raise ValueError(f"received post data wasn't a valid Gorilla formatted JSON object: {msg}")
+
+def decode_event(jobj: dict, config: Config) -> Event:
+    """ validates a Gorilla event and extracts the fields Ellen stores according to config.
+    Raises ValueError if jobj isn't a valid Gorilla event """
+    try:
+        return _decode(jobj, config)
+    except (KeyError, TypeError, AttributeError) as e:
+        _fail(f"unexpected structure ({type(e).__name__}: {e})")
+
+def _decode(jobj: dict, config: Config) -> Event:
+    if not isinstance(jobj, dict):
+        _fail("not an object")
+    id = jobj.get("id")
+    if not id:
+        _fail("missing id")
+    common = jobj.get("common")
+    if not common or not isinstance(common, dict):
+        _fail("missing common")
+    time = common.get("time")
+    eventType = common.get("type")
+    if not time or not eventType:
+        _fail("missing common.time or common.type")
+    timestamp = parse_time(time, config.TIMEZONE.lower() == "local")
+
+    img: GImage = None
+    images = jobj.get("images")
+    if images and not isinstance(images, list):
+        _fail("images is not a list")
+    if config.STORE_IMAGE and images:
+        # nf todo - what about a scene with multiple people, how does Gorilla send that?
+        kind = config.STORE_IMAGE_KIND
+        for iobj in reversed(images): # the last image of the wanted kind is the one that is kept
+            if kind in iobj["type"]:
+                b64 = iobj.get("dataBase64")
+                if b64:
+                    img = GImage(iobj["dataType"], iobj["dataFileName"], b64)
+                else:
+                    print(f"Image field was unavailable for gorilla event id: {id}")
+                break
+
+    candidates: List[Candidate] = []
+    fr = jobj.get("fr")
+    if fr:
+        cands = fr["candidates"]
+        if cands:
+            # only the first candidate's score is stored, the others are only recorded as known people
+            c = cands[0]
+            score = c["similiarityScore"]
+            try:
+                score = float(score) # scores are a number in range of [0,1]
+            except:
+                print("Failed to get score for candidate, likely was an error string, and not a float")
+                score = None # failed to convert to a number because what was received was likely an error string. Set default to None
+            candidates.append(Candidate(c["id"], c["displayName"], score))
+            for c in cands[1:]:
+                candidates.append(Candidate(c["id"], c["displayName"], None))
+    else:
+        print(f"fr data field was unavailable for gorilla event id: {id}")
+    return Event(id, timestamp, eventType, img, candidates)
+
+
+# # # # # # # # # # #
+#  Benchmark        #
+# # # # # # # # # # #
+
+def _legacy_decode(jobj: dict, config: Config):
+    """ the decoding done before this module existed: server.validate_format, followed by the parsing in libellen.receive_json """
+    if jobj is None or not isinstance(jobj, dict) or not jobj.get("id"):
+        return None
+    common = jobj.get("common")
+    if not common or not isinstance(common, dict) or not common.get("time") or not common.get("type"):
+        return None
+    id = jobj["id"]
+    timestamp = datetime.strptime(jobj["common"]["time"], "%Y-%m-%dT%H:%M:%S.%fZ")
+    if config.TIMEZONE.lower() == "local":
+        timestamp = timestamp.replace(tzinfo=timezone.utc).astimezone(tz=None).replace(tzinfo=None)
+    eventType = jobj["common"]["type"]
+    img = None
+    candidates = []
+    if config.STORE_IMAGE and jobj["images"]:
+        for iobj in jobj["images"]:
+            if config.STORE_IMAGE_KIND in iobj["type"]:
+                if "dataBase64" in iobj and iobj["dataBase64"]:
+                    img = GImage(iobj["dataType"], iobj["dataFileName"], iobj["dataBase64"])
+                else:
+                    img = None
+    if "fr" in jobj and jobj["fr"]:
+        if jobj["fr"]["candidates"]:
+            for c in jobj["fr"]["candidates"]:
+                score = c["similiarityScore"]
+                try:
+                    score = float(score)
+                except:
+                    score = None
+                candidates.append(Candidate(c["id"], c["displayName"], score))
+    candidate = candidates[0] if candidates else None
+    return id, timestamp, eventType, img, candidate, candidates
+
+def benchmark(n: int = 100000) -> Dict[str, float]:
+    """ measures the per-event CPU time of decoding a typical FACE event with the legacy path and with decode_event.
+    Returns microseconds per event for each """
+    import time as timer
+    config = Config(False, True, "FACE", 100, 10000, 30, "./data", "./", "SQL", 5000, "Local")
+    jobj = {
+        "id": "{8b1b4c1e-2b7a-4d4f-9a53-0c7c0e4f6b11}",
+        "common": {"time": "2020-08-01T10:00:00.123Z", "type": "FACE"},
+        "images": [
+            {"type": "SCENE", "dataType": "JPG", "dataFileName": "scene.jpg", "dataBase64": "AAAA"},
+            {"type": "FACE", "dataType": "JPG", "dataFileName": "face.jpg", "dataBase64": "AAAA"},
+        ],
+        "fr": {"candidates": [{"id": i, "displayName": f"Person {i}", "similiarityScore": "0.9"} for i in range(5)]},
+    }
+    results = {}
+    for name, fn in (("legacy", _legacy_decode), ("decode_event", decode_event)):
+        fn(jobj, config) # warm up
+        start = timer.process_time()
+        for _ in range(n):
+            fn(jobj, config)
+        results[name] = (timer.process_time() - start) / n * 1e6
+    return results
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"Decoding {n} events")
+    results = benchmark(n)
+    for name, us in results.items():
+        print(f"{name:>14}: {us:.2f} us/event")
+    print(f"{'speedup':>14}: {results['legacy'] / results['decode_event']:.2f}x")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
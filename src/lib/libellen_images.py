@@ -0,0 +1,147 @@
+from typing import List, Set, Dict, Tuple, Optional, Iterable, Callable
+import sys, os
+import base64
+import hashlib
+import mimetypes
+import tempfile
+import threading
+from .libellen_core import Config, GImage
+
+## Content-addressed image store
+# Images are saved once under DataDirectory/images, keyed by the sha256 of their decoded bytes,
+# and fanned out as images/ab/cd/abcd....jpg so that no single directory grows too large.
+# Storage rows only reference images by their hash. Since many rows may share an image, a pruned row's image is
+# only deleted once no row references it, see delete_unreferenced.
+_IMAGE_DIR = "images"
+_HASH_LEN = 64 # length of a hex encoded sha256 digest
+
+_CONFIG: Config = None
+_LOCK = threading.Lock()
+# hash -> number of events that have stored or reused the image, but whose row isn't written yet.
+# Pinned images are never deleted, so garbage collection can't remove an image that a row is about to reference
+_PINNED: Dict[str, int] = {}
+
+def set_config(config: Config):
+    global _CONFIG
+    _CONFIG = config
+    return
+
+def _get_store_root() -> str:
+    if _CONFIG is None:
+        return os.path.join(".", "data", _IMAGE_DIR)
+    else:
+        return os.path.join(_CONFIG.SAVE_PATH, _IMAGE_DIR)
+
+def _get_fanout_dir(hash: str) -> str:
+    """ returns the subdirectory that an image with the given hash lives in """
+    return os.path.join(_get_store_root(), hash[0:2], hash[2:4])
+
+def _clean_ext(ext: str) -> str:
+    """ Gorilla supplies the extension itself, so strip anything that shouldn't be in a filename """
+    ext = "".join(c for c in (ext or "") if c.isalnum()).lower()
+    return ext or "bin"
+
+def is_valid_hash(hash: str) -> bool:
+    """ checks that hash looks like one of our image keys, so it is safe to use in a path """
+    return len(hash) == _HASH_LEN and all(c in "0123456789abcdef" for c in hash)
+
+def pin(hash: str):
+    """ protects the image from delete_unreferenced until unpin is called, once the row referencing it has been written """
+    with _LOCK:
+        _PINNED[hash] = _PINNED.get(hash, 0) + 1
+    return
+
+def unpin(hash: str):
+    with _LOCK:
+        n = _PINNED.get(hash, 0) - 1
+        if n > 0:
+            _PINNED[hash] = n
+        else:
+            _PINNED.pop(hash, None)
+    return
+
+def store_bytes(data: bytes, ext: str, pin_image: bool = False) -> str:
+    """ saves the image bytes into the store if they are not already present. Returns the content hash.
+    If pin_image is True, the image is pinned before it is looked for, and the caller must unpin it once its row is written """
+    hash = hashlib.sha256(data).hexdigest()
+    if not pin_image:
+        return _write(hash, data, ext)
+    pin(hash) # before the existence check, so the file can't be collected between the check and the row being written
+    try:
+        return _write(hash, data, ext)
+    except Exception:
+        unpin(hash)
+        raise
+
+def _write(hash: str, data: bytes, ext: str) -> str:
+    d = _get_fanout_dir(hash)
+    path = os.path.join(d, f"{hash}.{_clean_ext(ext)}")
+    if os.path.isfile(path):
+        return hash # content addressed, so identical images are only ever written once
+    os.makedirs(d, exist_ok=True)
+    # each writer gets its own temp file, as request threads may be storing the same image at the same time
+    fd, tmp = tempfile.mkstemp(dir=d, prefix=f"{hash}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path) # atomic, readers never see a half-written image
+    except OSError:
+        if not os.path.isfile(path):
+            raise
+        # another writer got there first (Windows refuses to replace a file that is open), and it holds the same bytes
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return hash
+
+def store_image(img: GImage, pin_image: bool = False) -> str:
+    """ decodes the b64 data of a GImage, saves it into the store, and records the hash on img.Hash. Returns the hash """
+    img.Hash = store_bytes(base64.b64decode(img.B64), img.Ext, pin_image)
+    return img.Hash
+
+def delete_unreferenced(hashes: Iterable[str], is_referenced: Callable[[str], bool]) -> List[str]:
+    """ deletes the stored images among hashes that is_referenced(hash) says no row uses any more, skipping pinned ones.
+    Must be called with the store lock held, so that is_referenced sees every written row. Returns the hashes deleted """
+    deleted = []
+    for hash in set(h for h in hashes if h and is_valid_hash(h)):
+        if is_referenced(hash):
+            continue
+        with _LOCK: # pin() can't slip in between the check and the delete
+            if hash in _PINNED:
+                continue
+            path = find_image(hash)
+            if path is None:
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Failed to delete unreferenced image {path}: {e}")
+                continue
+        deleted.append(hash)
+    return deleted
+
+def find_image(hash: str) -> str:
+    """ returns the path on disk of the image with the given hash, or None if it isn't stored """
+    if not is_valid_hash(hash):
+        return None
+    d = _get_fanout_dir(hash)
+    try:
+        for name in os.listdir(d):
+            if name.startswith(hash + ".") and not name.endswith(".tmp"):
+                return os.path.join(d, name)
+    except FileNotFoundError:
+        return None
+    return None
+
+def read_image(hash: str) -> bytes:
+    """ returns the bytes of the image with the given hash, or None if it isn't stored """
+    path = find_image(hash)
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+def guess_mimetype(path: str) -> str:
+    """ returns the mimetype for a stored image path based on its extension """
+    mt, _ = mimetypes.guess_type(path)
+    return mt or "application/octet-stream"
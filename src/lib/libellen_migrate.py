@@ -0,0 +1,429 @@
+from typing import List, Set, Dict, Tuple, Optional
+import sys, os
+import io
+import re
+import json
+import shutil
+import base64
+import hashlib
+import posixpath
+import threading
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from .libellen_core import Config
+from . import libellen_images
+
+## Bulk migration between the XLS and SQL backing stores
+# XLS -> SQL streams every workbook (rolled over ones first, then the live ellen.xlsx) in openpyxl read-only mode,
+# and inserts the rows into ellen.sqlite in batched transactions. Embedded images are pulled straight out of the
+# xlsx zip and put into the image store.
+# SQL -> XLS streams ellen.sqlite in Id order into write-only workbooks of at most MaxRecordCount rows each.
+# They are named like rolled over workbooks, so that the XLS store and a later XLS -> SQL migration treat them as history.
+# Progress is checkpointed to DataDirectory/migrate.json after each batch, so an interrupted migration resumes where it stopped.
+DIRECTION_XLS_TO_SQL = "xls2sql"
+DIRECTION_SQL_TO_XLS = "sql2xls"
+
+_BATCH_SIZE = 1000
+_CHECKPOINT_NAME = "migrate.json"
+_XLSNAME = "ellen.xlsx"
+_SHEET_BAP = "People"
+_SHEET_IVAR = "Entries"
+_IMAGE_HEIGHT = 64
+_ROLLOVER_RE = re.compile(r"^ellen-(\d{4}-\d{2}-\d{2})\.(\d+)\.xlsx$")
+
+# xlsx xml namespaces
+_NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+_NS_XDR = "http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing"
+_NS_A = "http://schemas.openxmlformats.org/drawingml/2006/main"
+
+_CONFIG: Config = None
+_LOCK = threading.Lock()
+_STATUS: Dict[str, object] = {
+    "running": False,
+    "direction": None,
+    "file": None,
+    "rows": 0,
+    "images": 0,
+    "error": None,
+    "finished": None,
+}
+
+def set_config(config: Config):
+    global _CONFIG
+    _CONFIG = config
+    return
+
+def _update_status(**kwargs):
+    with _LOCK:
+        _STATUS.update(kwargs)
+    return
+
+def _bump_status(key: str, n: int = 1):
+    with _LOCK:
+        _STATUS[key] += n
+    return
+
+def get_status() -> Dict[str, object]:
+    """ returns a copy of the progress of the current or last migration """
+    with _LOCK:
+        return dict(_STATUS)
+
+def _get_checkpoint_path() -> str:
+    return os.path.join(_CONFIG.SAVE_PATH, _CHECKPOINT_NAME)
+
+def _load_checkpoint(direction: str) -> dict:
+    """ returns the saved progress for direction, or a fresh checkpoint if there is none """
+    try:
+        with open(_get_checkpoint_path()) as f:
+            cp = json.load(f)
+        if cp.get("direction") == direction:
+            return cp
+    except (FileNotFoundError, ValueError):
+        pass
+    return {"direction": direction}
+
+def _save_checkpoint(cp: dict):
+    """ atomically writes the checkpoint, so a crash mid-write never loses the previous one """
+    path = _get_checkpoint_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(cp, f)
+    os.replace(tmp, path)
+    return
+
+def clear_checkpoint():
+    """ forgets any saved progress, so the next migration starts from the beginning """
+    try:
+        os.remove(_get_checkpoint_path())
+    except FileNotFoundError:
+        pass
+    return
+
+def _next_rollover_number(date: str) -> int:
+    """ the first unused N for rolled over workbooks named ellen-date.N.xlsx """
+    used = [int(m.group(2)) for m in (_ROLLOVER_RE.match(x) for x in os.listdir(_CONFIG.OUTPUT_PATH)) if m and m.group(1) == date]
+    return max(used, default=0) + 1
+
+def find_workbooks() -> List[str]:
+    """ returns the names of the rolled over workbooks in OutputDirectory, oldest first """
+    found = []
+    for name in os.listdir(_CONFIG.OUTPUT_PATH):
+        m = _ROLLOVER_RE.match(name)
+        if m:
+            found.append((m.group(1), int(m.group(2)), name))
+    return [x[2] for x in sorted(found)]
+
+
+# # # # # # # # # # #
+#  XLS -> SQL       #
+# # # # # # # # # # #
+
+def _resolve_target(base: str, target: str) -> str:
+    """ resolves a relationship target to a zip member name. Targets are either absolute (/xl/...) or relative to base's folder """
+    if target.startswith("/"):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base), target))
+
+def _read_rels(zf: zipfile.ZipFile, part: str) -> Dict[str, str]:
+    """ returns the relationship id -> zip member mapping for the given part """
+    rels_path = posixpath.join(posixpath.dirname(part), "_rels", posixpath.basename(part) + ".rels")
+    try:
+        root = ET.fromstring(zf.read(rels_path))
+    except KeyError:
+        return {}
+    return {r.get("Id"): _resolve_target(part, r.get("Target")) for r in root.iter(f"{{{_NS_PKG_REL}}}Relationship")}
+
+def _read_image_anchors(path: str, sheetname: str) -> Dict[int, str]:
+    """ read-only workbooks don't load images, so find them ourselves: returns a mapping of
+    1-indexed row -> zip member of the image anchored on that row of the named sheet """
+    anchors: Dict[int, str] = {}
+    with zipfile.ZipFile(path) as zf:
+        wb_part = "xl/workbook.xml"
+        wb_rels = _read_rels(zf, wb_part)
+        sheet_part = None
+        for s in ET.fromstring(zf.read(wb_part)).iter(f"{{{_NS_MAIN}}}sheet"):
+            if s.get("name") == sheetname:
+                sheet_part = wb_rels.get(s.get(f"{{{_NS_REL}}}id"))
+        if sheet_part is None:
+            return anchors
+        for drawing_part in [t for t in _read_rels(zf, sheet_part).values() if "/drawings/" in t]:
+            media = _read_rels(zf, drawing_part)
+            # iterparse so that drawings with hundreds of thousands of anchors aren't built into one tree
+            row = None
+            for event, el in ET.iterparse(zf.open(drawing_part), events=("end",)):
+                if el.tag == f"{{{_NS_XDR}}}row" and row is None:
+                    row = int(el.text) + 1 # the first row element of an anchor is its 'from' row, which is 0-indexed
+                elif el.tag == f"{{{_NS_A}}}blip":
+                    target = media.get(el.get(f"{{{_NS_REL}}}embed"))
+                    if target and row is not None:
+                        anchors[row] = target
+                elif el.tag in (f"{{{_NS_XDR}}}oneCellAnchor", f"{{{_NS_XDR}}}twoCellAnchor", f"{{{_NS_XDR}}}absoluteAnchor"):
+                    row = None
+                    el.clear()
+    return anchors
+
+def _insert_ivar_batch(conn, batch: List[tuple]):
+    sql = "INSERT OR IGNORE INTO ivardata (GorillaId, Timestamp, EventType, PersonId, Confidence, ImageHash, FullBlob) VALUES (?,?,?,?,?,?,?);"
+    c = conn.cursor()
+    c.executemany(sql, batch)
+    c.close()
+    conn.commit()
+    return
+
+def _unpin_all(hashes: List[str]):
+    for h in hashes:
+        libellen_images.unpin(h)
+    hashes.clear()
+    return
+
+def _migrate_workbook_to_sql(path: str, conn, start_row: int, on_batch) -> int:
+    """ streams the rows of the workbook at path into conn, starting after start_row.
+    on_batch(last_row, rows) is called after every committed batch. Returns the number of rows read """
+    import openpyxl
+    anchors = _read_image_anchors(path, _SHEET_IVAR)
+    wb = openpyxl.load_workbook(path, read_only=True)
+    count = 0
+    try:
+        c = conn.cursor()
+        if _SHEET_BAP in wb.sheetnames:
+            bap = [(r[0], r[1] if len(r) > 1 else None) for r in wb[_SHEET_BAP].iter_rows(min_row=2, values_only=True) if r and r[0] is not None]
+            c.executemany("INSERT OR IGNORE INTO bapdata (BapId, PersonName) VALUES (?,?);", bap)
+        c.close()
+        conn.commit()
+
+        batch = []
+        pinned = [] # images stored for the batch, pinned until its rows are committed so a prune can't collect them
+        first_row = max(start_row + 1, 2) # row 1 is the header
+        row_num = first_row - 1
+        with zipfile.ZipFile(path) as zf:
+            for row_num, row in enumerate(wb[_SHEET_IVAR].iter_rows(min_row=first_row, values_only=True), start=first_row):
+                if not row or row[0] is None:
+                    continue
+                gorillaId, timestamp, eventType, pid, score, imghash, jobj = (tuple(row) + (None,) * 7)[:7]
+                if not (imghash and libellen_images.is_valid_hash(str(imghash))):
+                    imghash = None
+                    member = anchors.get(row_num)
+                    if member:
+                        imghash = libellen_images.store_bytes(zf.read(member), posixpath.splitext(member)[1], pin_image=True)
+                        pinned.append(imghash)
+                        _bump_status("images")
+                batch.append((gorillaId, timestamp, eventType, pid, score, imghash, jobj))
+                count += 1
+                if len(batch) >= _BATCH_SIZE:
+                    _insert_ivar_batch(conn, batch)
+                    on_batch(row_num, len(batch))
+                    batch = []
+                    _unpin_all(pinned)
+            if batch:
+                _insert_ivar_batch(conn, batch)
+            on_batch(row_num, len(batch))
+    finally:
+        _unpin_all(pinned)
+        wb.close()
+    return count
+
+def migrate_xls_to_sql(conn, live_store_lock=None) -> int:
+    """ copies every workbook into the SQL db behind conn. Returns the number of rows read.
+    The live ellen.xlsx is snapshotted under live_store_lock first, so that ingestion can keep writing to it """
+    cp = _load_checkpoint(DIRECTION_XLS_TO_SQL)
+    done: List[str] = cp.setdefault("done", [])
+    total = 0
+    for name in find_workbooks():
+        if name in done:
+            continue
+        start_row = cp.get("row", 0) if cp.get("file") == name else 0
+        _update_status(file=name)
+        def on_batch(last_row: int, rows: int):
+            cp["file"] = name
+            cp["row"] = last_row
+            _save_checkpoint(cp)
+            _bump_status("rows", rows)
+        total += _migrate_workbook_to_sql(os.path.join(_CONFIG.OUTPUT_PATH, name), conn, start_row, on_batch)
+        done.append(name) # rolled over workbooks never change again, so they are never re-read
+        cp["file"] = None
+        cp["row"] = 0
+        _save_checkpoint(cp)
+
+    # the live workbook keeps changing, so it is always re-read in full. INSERT OR IGNORE skips rows already migrated
+    live = os.path.join(_CONFIG.OUTPUT_PATH, _XLSNAME)
+    if os.path.isfile(live):
+        snapshot = os.path.join(_CONFIG.SAVE_PATH, f"migrate-{_XLSNAME}")
+        os.makedirs(_CONFIG.SAVE_PATH, exist_ok=True)
+        if live_store_lock is not None:
+            with live_store_lock:
+                shutil.copyfile(live, snapshot)
+        else:
+            shutil.copyfile(live, snapshot)
+        _update_status(file=_XLSNAME)
+        try:
+            total += _migrate_workbook_to_sql(snapshot, conn, 0, lambda last_row, rows: _bump_status("rows", rows))
+        finally:
+            os.remove(snapshot)
+    return total
+
+
+# # # # # # # # # # #
+#  SQL -> XLS       #
+# # # # # # # # # # #
+
+def _thumbnail(data: bytes) -> io.BytesIO:
+    """ resizes image bytes to the square thumbnail size used by the XLS store """
+    from PIL import Image
+    out = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as im:
+        fmt = im.format or "PNG"
+        im.resize((_IMAGE_HEIGHT, _IMAGE_HEIGHT)).save(out, format=fmt)
+    out.seek(0)
+    return out
+
+def _image_for_row(imghash: str, imgb64: str) -> Tuple[str, bytes]:
+    """ returns the image hash and bytes for an ivardata row. Rows written before the image store have their image
+    inline as base64. It is only embedded in the workbook, not put in the store, where no row would reference it """
+    if imghash:
+        return imghash, libellen_images.read_image(imghash)
+    if imgb64:
+        data = base64.b64decode(imgb64)
+        return hashlib.sha256(data).hexdigest(), data
+    return None, None
+
+def _write_part(conn, name: str, after_id: int) -> Tuple[int, int]:
+    """ writes up to MaxRecordCount rows with an Id above after_id into a new write-only workbook.
+    Returns (last Id written, number of rows) """
+    import openpyxl
+    from openpyxl.drawing.image import Image
+    if conn.execute("SELECT 1 FROM ivardata WHERE Id > ? LIMIT 1;", (after_id,)).fetchone() is None:
+        return after_id, 0 # nothing left, don't start a workbook that would never be saved
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(_SHEET_IVAR)
+    ws.append(("GorillaId", "Timestamp", "Event Type", "PersonId", "Confidence", "Image", "FullBlob"))
+    bap = wb.create_sheet(_SHEET_BAP)
+    bap.append(("BAPId", "Display Name"))
+    for r in conn.execute("SELECT BapId, PersonName FROM bapdata ORDER BY BapId;"):
+        bap.append(r)
+
+    c = conn.cursor()
+    c.execute("""SELECT Id, GorillaId, Timestamp, EventType, PersonId, Confidence, ImageHash, ImageData, FullBlob
+        FROM ivardata WHERE Id > ? ORDER BY Id LIMIT ?;""", (after_id, _CONFIG.MAX_RECORD_COUNT))
+    last_id = after_id
+    count = 0
+    while True:
+        rows = c.fetchmany(_BATCH_SIZE)
+        if not rows:
+            break
+        for id, gorillaId, timestamp, eventType, pid, score, imghash, imgb64, jobj in rows:
+            if isinstance(timestamp, str):
+                try:
+                    timestamp = datetime.fromisoformat(timestamp)
+                except ValueError:
+                    pass
+            imghash, data = _image_for_row(imghash, imgb64)
+            ws.append((gorillaId, timestamp, eventType, pid, score, imghash, jobj))
+            count += 1
+            if data:
+                try:
+                    ws.add_image(Image(_thumbnail(data)), f"F{count + 1}") # +1 for the header row
+                    _bump_status("images")
+                except Exception as e:
+                    print(f"Failed to embed image for gorilla event id {gorillaId}: {e}")
+            last_id = id
+        _bump_status("rows", len(rows))
+    c.close()
+    if count:
+        path = os.path.join(_CONFIG.OUTPUT_PATH, name)
+        tmp = f"{path}.tmp"
+        _update_status(file=name)
+        wb.save(tmp)
+        os.replace(tmp, path) # a part only appears once it is complete
+    return last_id, count
+
+def migrate_sql_to_xls(conn) -> int:
+    """ copies the SQL db behind conn into ellen-YYYY-MM-DD.N.xlsx workbooks, named as if they were rolled over today.
+    Returns the number of rows written """
+    cp = _load_checkpoint(DIRECTION_SQL_TO_XLS)
+    if "date" not in cp:
+        # fixed when the migration starts, so a resumed migration rewrites the same names instead of adding parts
+        cp["date"] = datetime.now().strftime('%Y-%m-%d')
+        cp["first_number"] = _next_rollover_number(cp["date"])
+        _save_checkpoint(cp)
+    total = 0
+    while True:
+        part = cp.get("part", 0) + 1
+        name = f"ellen-{cp['date']}.{cp['first_number'] + part - 1}.xlsx"
+        last_id, n = _write_part(conn, name, cp.get("last_id", 0))
+        if n == 0:
+            break
+        total += n
+        cp["part"] = part
+        cp["last_id"] = last_id
+        _save_checkpoint(cp)
+    return total
+
+
+def run_migration(direction: str, live_store_lock=None) -> int:
+    """ runs a migration in the given direction, resuming from any saved checkpoint. Returns the number of rows migrated """
+    from . import libellen_sql
+    _update_status(running=True, direction=direction, file=None, rows=0, images=0, error=None, finished=None)
+    conn = None
+    try: # everything from here on is inside the try, so that a failure always clears running and records the error
+        if direction not in (DIRECTION_XLS_TO_SQL, DIRECTION_SQL_TO_XLS):
+            raise AttributeError(f"Migration direction must be oneof '{DIRECTION_XLS_TO_SQL}', '{DIRECTION_SQL_TO_XLS}'")
+        libellen_images.set_config(_CONFIG)
+        if live_store_lock is not None:
+            with live_store_lock: # the SQL store may be the active one, don't reset its connection under a writer
+                libellen_sql.set_config(_CONFIG)
+                libellen_sql.ensure()
+        else:
+            libellen_sql.set_config(_CONFIG)
+            libellen_sql.ensure()
+        conn = libellen_sql._connect() # a separate connection, the shared one belongs to request threads
+        if direction == DIRECTION_XLS_TO_SQL:
+            total = migrate_xls_to_sql(conn, live_store_lock)
+        else:
+            total = migrate_sql_to_xls(conn)
+        _update_status(finished=datetime.now().isoformat())
+        return total
+    except Exception as e:
+        _update_status(error=str(e))
+        raise
+    finally:
+        if conn is not None:
+            conn.close()
+        _update_status(running=False)
+
+def start_migration(direction: str, live_store_lock=None) -> bool:
+    """ runs a migration on a background thread. Returns False if one is already running """
+    with _LOCK:
+        if _STATUS["running"]:
+            return False
+        _STATUS["running"] = True
+    def run():
+        try:
+            n = run_migration(direction, live_store_lock)
+            print(f"Migration {direction} finished, {n} rows migrated")
+        except Exception as e:
+            print(f"Migration {direction} failed: {e}")
+    threading.Thread(target=run, name="ellen-migrate", daemon=True).start()
+    return True
+
+def main():
+    from . import libellen
+    if len(sys.argv) < 2 or sys.argv[1] not in (DIRECTION_XLS_TO_SQL, DIRECTION_SQL_TO_XLS):
+        print(f"usage: python -m lib.libellen_migrate [{DIRECTION_XLS_TO_SQL}|{DIRECTION_SQL_TO_XLS}] [--restart]")
+        return 1
+    conf = libellen.read_config()
+    if not conf:
+        print("Failed to load config.ini")
+        return 1
+    set_config(conf)
+    if "--restart" in sys.argv:
+        clear_checkpoint()
+    n = run_migration(sys.argv[1])
+    print(f"Migrated {n} rows, {get_status()['images']} images")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+from typing import List, Set, Dict, Tuple, Optional
+import sys, os
+import threading
+import time
+from collections import Counter
+
+## On-demand sampling profiler
+# Nothing runs until profile() is called. It then samples the stacks of every thread with sys._current_frames
+# at a fixed interval, and stops when the requested time is up, so there is no cost while idle.
+_SAMPLE_INTERVAL = 0.005 # seconds between samples
+MAX_SECONDS = 60 # longest profile that may be requested
+_ELLEN_MODULES = ("lib.", "server", "__main__") # frames from these modules are Ellen's own code
+_OTHER = "<other>" # bucket for samples with no Ellen frame on the stack, like idle server threads
+
+_LOCK = threading.Lock() # only one profile may run at a time
+
+def _is_ellen_frame(frame) -> bool:
+    name = frame.f_globals.get("__name__", "")
+    return name.startswith(_ELLEN_MODULES)
+
+def _frame_label(frame) -> str:
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+def _package_of(frame) -> str:
+    """ the top level package a frame belongs to, e.g. openpyxl, PIL, sqlite3 """
+    return frame.f_globals.get("__name__", "?").split(".")[0]
+
+def _sample(skip: Set[int], stacks: Counter, by_function: Dict[str, Counter]):
+    """ takes one sample of every thread's stack, except those in skip """
+    for tid, frame in sys._current_frames().items():
+        if tid in skip:
+            continue
+        labels = []
+        ellen_fn = None
+        leaf_pkg = _package_of(frame)
+        f = frame
+        while f is not None:
+            labels.append(_frame_label(f))
+            if ellen_fn is None and _is_ellen_frame(f):
+                ellen_fn = f.f_code.co_name # innermost Ellen function, which is where the time is attributed
+            f = f.f_back
+        labels.reverse()
+        stacks[";".join(labels)] += 1
+        by_function.setdefault(ellen_fn or _OTHER, Counter())[leaf_pkg] += 1
+    return
+
+def profile(seconds: float) -> Tuple[Counter, Dict[str, Counter], int]:
+    """ samples all threads for the given number of seconds. Returns (collapsed stacks, samples per Ellen function
+    broken down by the package of the innermost frame, number of sampling rounds).
+    Returns None if a profile is already running """
+    seconds = max(0.0, min(float(seconds), MAX_SECONDS))
+    if not _LOCK.acquire(blocking=False):
+        return None
+    try:
+        stacks: Counter = Counter()
+        by_function: Dict[str, Counter] = {}
+        skip = {threading.get_ident()} # the caller is only waiting on us, so don't count it
+        rounds = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            _sample(skip, stacks, by_function)
+            rounds += 1
+            time.sleep(_SAMPLE_INTERVAL)
+        return stacks, by_function, rounds
+    finally:
+        _LOCK.release()
+
+def format_collapsed(stacks: Counter) -> str:
+    """ formats stacks as 'frame;frame;frame count' lines, as read by flamegraph.pl and speedscope """
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+def format_summary(by_function: Dict[str, Counter], rounds: int) -> Dict[str, object]:
+    """ formats the per-function samples as a dict sorted by most samples, for json output """
+    functions = []
+    for fn, pkgs in sorted(by_function.items(), key=lambda x: -sum(x[1].values())):
+        functions.append({
+            "function": fn,
+            "samples": sum(pkgs.values()),
+            "packages": dict(pkgs.most_common()),
+        })
+    return {
+        "interval_ms": _SAMPLE_INTERVAL * 1000,
+        "rounds": rounds,
+        "functions": functions,
+    }
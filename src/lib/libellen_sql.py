@@ -2,8 +2,10 @@ from typing import List, Set, Dict, Tuple, Optional
 import sys, os
 import sqlite3
 import json
+import time as timer
 from datetime import datetime, time, timedelta
 from .libellen_core import Config, Candidate, GImage
+from . import libellen_images
 ## Configuration Data related to Ellen's functioning
 # Path to the Database where we store our seen items
 _DBNAME = "ellen.sqlite"
@@ -11,6 +13,56 @@ _DBNAME = "ellen.sqlite"
 # Private Connection to the Database - we keep it open whenever we can
 _CONN: sqlite3.Connection = None
 _CONFIG: Config = None
+# Whether the schema of the current DB has been checked for columns added after its creation
+_SCHEMA_CHECKED: bool = False
+
+## Retention
+# Each prune pass deletes rows oldest-first in chunks of this many rows, committing between chunks so writers can get in
+_PRUNE_CHUNK_ROWS = 500
+# Free pages handed back to the OS per incremental_vacuum step
+_VACUUM_STEP_PAGES = 256
+# Wall clock seconds a single prune pass may spend before it stops and leaves the rest for the next pass
+_PRUNE_TIME_BUDGET = 0.25
+# Set when the last prune pass ran out of time before the DB was within its limits
+_PRUNE_PENDING: bool = False
+_AUTO_VACUUM_INCREMENTAL = 2
+# Whether prune has already said that this DB predates incremental auto_vacuum
+_VACUUM_NOTICE_SHOWN: bool = False
+
+## Performance profiles, chosen with 'profile' under [SQL] in config.ini and applied whenever a connection opens.
+# durable is SQLite's defaults, and survives power loss without losing a committed event.
+# balanced uses WAL with synchronous=NORMAL: the DB can't corrupt, but the last events before a power cut may be lost.
+# fast doesn't wait for the disk at all, and a crash of the OS may corrupt the DB.
+# page_size only takes effect for new DBs.
+PROFILE_DURABLE = "durable"
+PROFILE_BALANCED = "balanced"
+PROFILE_FAST = "fast"
+PROFILES: Dict[str, Dict[str, object]] = {
+    PROFILE_DURABLE: {
+        "page_size": 4096,
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "cache_size": -2000, # negative values are in KiB, so 2MB
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+    },
+    PROFILE_BALANCED: {
+        "page_size": 4096,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -16000,
+        "mmap_size": 64 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+    PROFILE_FAST: {
+        "page_size": 8192,
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
 
 def _getDBPath() -> str:
     if _CONFIG is None:
@@ -18,15 +70,46 @@ def _getDBPath() -> str:
     else:
         return os.path.join(_CONFIG.OUTPUT_PATH, _DBNAME)
 
-def _open_conn() -> sqlite3.Connection:
+def _get_profile() -> Dict[str, object]:
+    if _CONFIG is None:
+        return PROFILES[PROFILE_DURABLE]
+    return PROFILES.get(_CONFIG.SQL_PROFILE.lower(), PROFILES[PROFILE_DURABLE])
+
+def _connect() -> sqlite3.Connection:
+    """ opens a new connection to the DB, with the pragmas of the configured performance profile applied """
     dbpath = _getDBPath()
     p = os.path.dirname(dbpath)
     os.makedirs(p, exist_ok=True)
-    return sqlite3.connect(dbpath)
+    new_db = not os.path.isfile(dbpath)
+    conn = sqlite3.connect(dbpath, check_same_thread=False) # shared between request threads, which take turns via the store lock
+    if new_db:
+        # must be set before any table is created, and before WAL mode. Lets prune_old_data give freed pages back to the OS a few at a time
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    profile = _get_profile()
+    # page_size must come before journal_mode, it can't be changed once the DB is in WAL mode
+    for pragma in ("page_size", "journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store"):
+        conn.execute(f"PRAGMA {pragma} = {profile[pragma]};").fetchall()
+    return conn
+
+def _open_conn() -> sqlite3.Connection:
+    """ returns the shared connection to the DB, opening it if needed """
+    global _CONN
+    if _CONN is None:
+        _CONN = _connect()
+    return _CONN
+
+def _close_conn() -> None:
+    """ closes the shared connection, so the next _open_conn reopens the DB file """
+    global _CONN
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
+    return
 
 def _check_db_exists() -> bool:
     """Checks that the Sqlite DB exits"""
     if not os.path.isfile(_getDBPath()):
+        _close_conn() # the file was removed from under us, don't keep writing to the deleted file
         return False
     try:
         return _open_conn() is not None
@@ -37,6 +120,7 @@ def _check_db_exists() -> bool:
 def _remove_old_db() -> None:
     """removes any invalid or corrupt db file we had for whatever reason. """
     dbpath = _getDBPath()
+    _close_conn()
     try:
         print(f"Removing old db at {dbpath}")
         os.remove(dbpath)
@@ -71,47 +155,171 @@ def _establish_new_db() -> bool:
         "Confidence"    INTEGER,
         "ImageData" BLOB,
         "FullBlob"  BLOB,
+        "ImageHash" TEXT,
         FOREIGN KEY("PersonId") REFERENCES "bapdata"("BapId")
     );
     """
     c.execute(sql)
+    # retention deletes oldest-first, so keep the rows ordered by time
+    c.execute('CREATE INDEX IF NOT EXISTS "ivardata_timestamp" ON "ivardata" ("Timestamp");')
+    # images are only deleted once no row references them, which prune looks up by hash
+    c.execute('CREATE INDEX IF NOT EXISTS "ivardata_imagehash" ON "ivardata" ("ImageHash");')
     c.close()
     _CONN.commit()
     return True
 
+def _upgrade_db() -> None:
+    """adds any columns missing from DBs created by older versions of Ellen """
+    _CONN = _open_conn()
+    c = _CONN.cursor()
+    cols = [x[1] for x in c.execute("PRAGMA table_info(ivardata)").fetchall()]
+    if "ImageHash" not in cols:
+        print("Adding ImageHash column to ivardata")
+        c.execute("ALTER TABLE ivardata ADD COLUMN ImageHash TEXT;")
+    c.execute('CREATE INDEX IF NOT EXISTS "ivardata_timestamp" ON "ivardata" ("Timestamp");')
+    # images are only deleted once no row references them, which prune looks up by hash
+    c.execute('CREATE INDEX IF NOT EXISTS "ivardata_imagehash" ON "ivardata" ("ImageHash");')
+    c.close()
+    _CONN.commit()
+    return
+
 def _ensure_db() -> bool:
     """Ensures that our DB exists, and creates a new one if not"""
+    global _SCHEMA_CHECKED
     if not _check_db_exists():
+        _SCHEMA_CHECKED = True
         return _establish_new_db()
+    if not _SCHEMA_CHECKED:
+        _upgrade_db()
+        _SCHEMA_CHECKED = True
     return False
 
 def ensure() -> bool:
     return _ensure_db()
 
 def set_config(config: Config):
-    global _CONFIG
+    global _CONFIG, _SCHEMA_CHECKED
     _CONFIG = config
+    _SCHEMA_CHECKED = False
+    _close_conn() # the path or profile may have changed
     return
 
-def prune_old_data() -> int:
-    """Checks various conditions, like max_rows, max_date, etc, in the DB and prunes any data that qualifies. Returns the number of records expunged. """
+def _used_bytes(c: sqlite3.Cursor) -> int:
+    """ bytes of the DB file holding data, excluding free pages that are waiting to be vacuumed """
+    page_size = c.execute("PRAGMA page_size;").fetchone()[0]
+    page_count = c.execute("PRAGMA page_count;").fetchone()[0]
+    free_count = c.execute("PRAGMA freelist_count;").fetchone()[0]
+    return (page_count - free_count) * page_size
+
+def _delete_oldest(conn: sqlite3.Connection, limit: int, before: datetime = None) -> Tuple[int, List[str]]:
+    """ deletes up to limit of the oldest rows, optionally only those at or before the given time.
+    Returns the number deleted, and the image hashes those rows referenced """
+    c = conn.cursor()
+    if before is None:
+        rows = c.execute("SELECT Id, ImageHash FROM ivardata ORDER BY Timestamp, Id LIMIT ?;", (limit,)).fetchall()
+    else:
+        rows = c.execute("SELECT Id, ImageHash FROM ivardata WHERE Timestamp <= ? ORDER BY Timestamp, Id LIMIT ?;", (before, limit,)).fetchall()
+    c.executemany("DELETE FROM ivardata WHERE Id = ?;", [(r[0],) for r in rows])
+    c.close()
+    conn.commit()
+    return len(rows), [r[1] for r in rows if r[1]]
+
+def _prune_chunk(conn: sqlite3.Connection, limit: int, before: datetime = None) -> int:
+    """ deletes up to limit of the oldest rows like _delete_oldest, then deletes the images that no remaining row references.
+    Returns the number of rows deleted """
+    deleted, hashes = _delete_oldest(conn, limit, before)
+    if hashes:
+        def is_referenced(hash: str) -> bool:
+            return conn.execute("SELECT 1 FROM ivardata WHERE ImageHash = ? LIMIT 1;", (hash,)).fetchone() is not None
+        libellen_images.delete_unreferenced(hashes, is_referenced)
+    return deleted
+
+def _incremental_vacuum_enabled(conn: sqlite3.Connection) -> bool:
+    """ DBs created by older versions of Ellen don't have incremental auto_vacuum. Their freed pages stay in the file,
+    and are reused by new rows, until enable_incremental_vacuum is run """
+    return conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == _AUTO_VACUUM_INCREMENTAL
+
+def enable_incremental_vacuum() -> bool:
+    """ switches the DB to incremental auto_vacuum. This takes a full VACUUM, which locks the DB until it has rewritten
+    the whole file, so prune never does it; run it with the server stopped via `python -m lib.libellen_sql --vacuum`.
+    Returns False if the DB already had it """
     _CONN = _open_conn()
-    c = _CONN.cursor()
-    
-    rowcount = c.execute("SELECT COUNT(*) FROM ivardata").fetchone()[0]
-    # Check for number of rows beyond max row count
-    excess_rows = rowcount - _CONFIG.MAX_RECORD_COUNT
-    if excess_rows > 0:
-            c.execute("Delete from ivardata where rowid IN (Select rowid from ivardata limit ?);", (excess_rows,))
+    if _incremental_vacuum_enabled(_CONN):
+        return False
+    _CONN.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    _CONN.execute("VACUUM;")
+    return True
+
+def prune_old_data(time_budget: float = _PRUNE_TIME_BUDGET) -> int:
+    """Checks various conditions, like max_rows, max_date, max_size, etc, in the DB and prunes any data that qualifies, oldest rows first.
+    Deletes happen in small chunks, and the pass stops after time_budget seconds so that it never stalls writers for long;
+    maintenance_pending() reports whether there is work left for another pass. Returns the number of records expunged. """
+    global _PRUNE_PENDING, _VACUUM_NOTICE_SHOWN
+    _CONN = _open_conn()
+    deadline = timer.perf_counter() + time_budget
+    expunged = 0
+    _PRUNE_PENDING = True
+    try:
+        # Check for number of rows beyond max row count
+        rowcount = _CONN.execute("SELECT COUNT(*) FROM ivardata").fetchone()[0]
+        excess_rows = rowcount - _CONFIG.MAX_RECORD_COUNT
+        while excess_rows > 0:
+            if timer.perf_counter() > deadline:
+                return expunged
+            deleted = _prune_chunk(_CONN, min(excess_rows, _PRUNE_CHUNK_ROWS))
+            if deleted == 0:
+                break
+            expunged += deleted
+            excess_rows -= deleted
 
-    # Check for items older than max keep days:
-    maxDate = datetime.now() - timedelta(days=_CONFIG.MAX_KEEP_DAYS)
-    rows = c.execute("DELETE FROM ivardata WHERE Timestamp <= ?", (maxDate, ))
+        # Check for items older than max keep days
+        maxDate = datetime.now() - timedelta(days=_CONFIG.MAX_KEEP_DAYS)
+        while True:
+            if timer.perf_counter() > deadline:
+                return expunged
+            deleted = _prune_chunk(_CONN, _PRUNE_CHUNK_ROWS, maxDate)
+            expunged += deleted
+            if deleted < _PRUNE_CHUNK_ROWS:
+                break
 
-    new_rowcount = c.execute("SELECT COUNT(*) FROM ivardata").fetchone()[0]
-    c.close()
-    _CONN.commit()
-    return rowcount - new_rowcount
+        # Check the size of the data against max db size. Images live in the image store, outside the DB, and aren't counted
+        max_bytes = int(_CONFIG.MAX_SIZE * 1e6)
+        c = _CONN.cursor()
+        used = _used_bytes(c)
+        while used > max_bytes:
+            if timer.perf_counter() > deadline:
+                return expunged
+            rowcount = c.execute("SELECT COUNT(*) FROM ivardata").fetchone()[0]
+            if rowcount == 0:
+                break
+            # estimate how many rows make up the excess, so small DBs aren't emptied a whole chunk at a time
+            excess_rows = -(-(used - max_bytes) * rowcount // used)
+            deleted = _prune_chunk(_CONN, max(1, min(excess_rows, _PRUNE_CHUNK_ROWS)))
+            if deleted == 0:
+                break
+            expunged += deleted
+            used = _used_bytes(c)
+
+        # Give the freed pages back to the OS, a few at a time
+        incremental = _incremental_vacuum_enabled(_CONN)
+        if not incremental and not _VACUUM_NOTICE_SHOWN:
+            _VACUUM_NOTICE_SHOWN = True
+            print(f"{_getDBPath()} predates incremental auto_vacuum, so freed space is reused but not returned to the OS. "
+                  "To switch it over, stop the server and run `python -m lib.libellen_sql --vacuum` from the src directory")
+        while incremental and c.execute("PRAGMA freelist_count;").fetchone()[0] > 0:
+            if timer.perf_counter() > deadline:
+                return expunged
+            c.execute(f"PRAGMA incremental_vacuum({_VACUUM_STEP_PAGES});").fetchall()
+            _CONN.commit()
+        c.close()
+        _PRUNE_PENDING = False
+        return expunged
+    finally:
+        _CONN.commit()
+
+def maintenance_pending() -> bool:
+    """ True if the last prune pass ran out of its time budget before finishing """
+    return _PRUNE_PENDING
 
 
 def update_bap(candidates: List[Candidate]):
@@ -129,21 +337,72 @@ def update_bap(candidates: List[Candidate]):
     return
 
 def update_ivar(gorillaId: str, timestamp: datetime, eventType: str, img: GImage, candidate: Candidate, jobj: str):
-    """ Inserts data into the Ivar table. """
+    """ Inserts data into the Ivar table. Images are referenced by their hash in the image store, not stored inline """
     _CONN = _open_conn()
     c = _CONN.cursor()
 
-    sql = "INSERT INTO ivardata (GorillaId, Timestamp, EventType, PersonId, Confidence, ImageData, FullBlob) VALUES (?,?,?,?,?,?,?);"
+    sql = "INSERT INTO ivardata (GorillaId, Timestamp, EventType, PersonId, Confidence, ImageHash, FullBlob) VALUES (?,?,?,?,?,?,?);"
     pid = candidate.Id if candidate else None
     score = candidate.SimiliarityScore if candidate else None
-    imgb64 = img.B64 if img else None
-    c.execute(sql, (gorillaId, timestamp, eventType, pid, score, imgb64, jobj,))
+    imghash = img.Hash if img else None
+    c.execute(sql, (gorillaId, timestamp, eventType, pid, score, imghash, jobj,))
     c.close()
     _CONN.commit()
     return
 
 
+def benchmark_profiles(n: int = 2000) -> Dict[str, Dict[str, float]]:
+    """ inserts n events into a scratch DB with each profile, one commit per event like the server does,
+    then prunes half of them. Returns the events per second and prune seconds of each profile """
+    import tempfile
+    from .libellen_core import Config
+    global _CONFIG
+    old_config = _CONFIG
+    results = {}
+    try:
+        for name in PROFILES:
+            with tempfile.TemporaryDirectory() as d:
+                set_config(Config(False, True, "FACE", 1000, n // 2, 3650, d, d, "SQL", 5000, "Local", sql_profile=name))
+                _ensure_db()
+                cand = Candidate(1, "Benchmark Person", 0.9)
+                img = GImage("jpg", "face.jpg", None, "0" * 64)
+                blob = "x" * 1024 # about the size of a full Gorilla json without images
+                start = timer.perf_counter()
+                for i in range(n):
+                    update_bap([cand])
+                    update_ivar(f"{{{i}}}", datetime.now(), "FACE", img, cand, blob)
+                inserts = timer.perf_counter() - start
+                start = timer.perf_counter()
+                while prune_old_data() or maintenance_pending():
+                    pass
+                prune = timer.perf_counter() - start
+                results[name] = {"events_per_second": n / inserts, "prune_seconds": prune}
+                _close_conn()
+    finally:
+        set_config(old_config)
+    return results
+
 def main():
+    if "--benchmark" in sys.argv:
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        print(f"Benchmarking {n} inserts per profile")
+        for name, r in benchmark_profiles(n).items():
+            print(f"{name:>10}: {r['events_per_second']:8.0f} events/s, prune of {n // 2} rows {r['prune_seconds']:.3f}s")
+        return 0
+    if "--vacuum" in sys.argv:
+        from . import libellen
+        conf = libellen.read_config()
+        if not conf:
+            print("Failed to load config.ini")
+            return 1
+        set_config(conf)
+        print(f"Switching {_getDBPath()} to incremental auto_vacuum, this rewrites the whole file")
+        start = timer.perf_counter()
+        if enable_incremental_vacuum():
+            print(f"Done in {timer.perf_counter() - start:.1f}s")
+        else:
+            print("Already using incremental auto_vacuum, nothing to do")
+        return 0
     print("lib_elen_SQL:")
     print(f"Checking {_getDBPath()} exists: {_check_db_exists()}")
     print("Ensuring DB creation...")
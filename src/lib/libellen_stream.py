@@ -0,0 +1,110 @@
+from typing import List, Set, Dict, Tuple, Optional
+import json
+import threading
+import time
+from itertools import islice
+from collections import deque
+from .libellen_core import Candidate, GImage
+
+## Live event fan-out
+# Every stored event is published into a fixed size ring buffer. Subscribers don't get their own queues, they keep a
+# cursor into the ring and wait on a condition for new events, so publishing costs the same no matter how many
+# dashboards are connected. A subscriber that falls so far behind that the ring has overwritten its next event is dropped.
+_RING_SIZE = 1024
+MAX_SUBSCRIBERS = 32
+
+_COND = threading.Condition()
+_RING: deque = deque(maxlen=_RING_SIZE) # of (seq, record)
+# Sequence ids start from the process start time in microseconds, so that they keep increasing across restarts,
+# and a client resuming with an id from before a restart is told it missed events
+_SEQ = time.time_ns() // 1000
+_FIRST_SEQ = _SEQ + 1 # ids below this were handed out before this process started, if at all
+_SUBSCRIBERS = 0
+
+class Lagged(Exception):
+    """ raised to a subscriber whose next event has already been overwritten in the ring """
+    pass
+
+def publish(gorillaId: str, timestamp, eventType: str, img: GImage, candidate: Candidate) -> int:
+    """ adds a stored event to the ring and wakes the subscribers. Returns the event's sequence id """
+    global _SEQ
+    record = {
+        "GorillaId": gorillaId,
+        "Timestamp": timestamp.isoformat() if timestamp is not None else None,
+        "EventType": eventType,
+        "PersonId": candidate.Id if candidate else None,
+        "PersonName": candidate.DisplayName if candidate else None,
+        "Confidence": candidate.SimiliarityScore if candidate else None,
+        "ImageHash": img.Hash if img else None,
+    }
+    with _COND:
+        _SEQ += 1
+        _RING.append((_SEQ, record))
+        _COND.notify_all()
+        return _SEQ
+
+def last_seq() -> int:
+    """ the sequence id of the most recently published event """
+    with _COND:
+        return _SEQ
+
+def subscribe() -> bool:
+    """ registers a subscriber. Returns False if there are already MAX_SUBSCRIBERS """
+    global _SUBSCRIBERS
+    with _COND:
+        if _SUBSCRIBERS >= MAX_SUBSCRIBERS:
+            return False
+        _SUBSCRIBERS += 1
+        return True
+
+def unsubscribe():
+    global _SUBSCRIBERS
+    with _COND:
+        _SUBSCRIBERS -= 1
+    return
+
+def wait_for(after: int, timeout: float) -> List[Tuple[int, dict]]:
+    """ returns the events published after the sequence id after, waiting up to timeout seconds for one to arrive.
+    Returns an empty list on timeout. Raises Lagged if events after it have already been overwritten """
+    with _COND:
+        if _SEQ <= after:
+            _COND.wait(timeout)
+        if _SEQ <= after:
+            return []
+        oldest = _RING[0][0]
+        if after + 1 < oldest:
+            raise Lagged(f"missed {oldest - after - 1} events")
+        # the ring holds consecutive ids, so the wanted events are the newest _SEQ - after. Only those are walked and copied,
+        # from the newest end, as publish waits on _COND while the store lock is held
+        events = list(islice(reversed(_RING), _SEQ - after))
+        events.reverse()
+        return events
+
+def resume_from(lastId: Optional[int]) -> Tuple[int, Optional[dict]]:
+    """ works out where a new subscriber starts reading, given the last event id it saw, if any.
+    Returns (the id to read after, None or a gap describing the events it missed that are no longer in the ring).
+    The gap's missed count is None when lastId wasn't handed out by this process, as the events stored in between are unknown """
+    with _COND:
+        if lastId is None:
+            return _SEQ, None # new subscribers only get events from now on
+        oldest = _RING[0][0] if _RING else _SEQ + 1
+        if lastId < _FIRST_SEQ - 1 or lastId > _SEQ:
+            # from before a restart (or a different server), so send everything this process still has
+            return oldest - 1, {"missed": None, "restarted": True}
+        if lastId + 1 >= oldest:
+            return lastId, None
+        return oldest - 1, {"missed": oldest - lastId - 1, "restarted": False}
+
+def matches(record: dict, people: Set[str], types: Set[str]) -> bool:
+    """ checks a record against the subscriber's filters. Empty filters match everything """
+    if people and str(record["PersonId"]) not in people:
+        return False
+    if types and (record["EventType"] or "").upper() not in types:
+        return False
+    return True
+
+def format_sse(seq: int, record: dict) -> str:
+    return f"id: {seq}\nevent: gorilla\ndata: {json.dumps(record)}\n\n"
+
+def format_ndjson(seq: int, record: dict) -> str:
+    return json.dumps({"Id": seq, **record}) + "\n"
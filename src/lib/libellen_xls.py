@@ -7,6 +7,7 @@ import openpyxl
 from openpyxl.styles import NamedStyle
 from openpyxl.drawing.image import Image
 from .libellen_core import Config, Candidate, GImage, dump_b64_img_to_file, resize_image
+from . import libellen_images
 
 _CONFIG: Config = None
 _XLSNAME: str = "ellen.xlsx"
@@ -94,14 +95,16 @@ def _pixel_to_point(px: int) -> int:
     return px * 72 / 96
 
 def _get_image_path(img: GImage, gid: str) -> str:
-    """ returns the path on disk for where to save a GImage """
-    return  os.path.join(_CONFIG.SAVE_PATH, "img", f"{gid}.{img.Ext.lower()}")
+    """ returns the path on disk for where to save a GImage. Images already in the image store are keyed by their hash, so each thumbnail is only made once """
+    name = img.Hash if img.Hash else gid
+    return  os.path.join(_CONFIG.SAVE_PATH, "img", f"{name}.{img.Ext.lower()}")
 
 def _dump_and_resize_image(img: GImage, gid: str, square_size_px: int) -> Image:
     """ takes b64 encoded image data, and saves it to disk in the square dimensions supplied. Returns an openpyxl Image """
     path = _get_image_path(img, gid)
-    dump_b64_img_to_file(img.B64, path)
-    resize_image(path, _IMAGE_HEIGHT)
+    if not (img.Hash and os.path.isfile(path)):
+        dump_b64_img_to_file(img.B64, path)
+        resize_image(path, _IMAGE_HEIGHT)
     eimg: Image = Image(path)
     return eimg
 
@@ -172,9 +175,10 @@ def update_ivar(gorillaId: str, timestamp: datetime, eventType: str, img: GImage
     score = candidate.SimiliarityScore if candidate else None
     eimg: Image = None
 
-    sheet.append((gorillaId, timestamp, eventType, pid, score, None, jobj)) #image slot is None because we need to special insert it in the next step
+    imghash = img.Hash if img else None
+    sheet.append((gorillaId, timestamp, eventType, pid, score, imghash, jobj)) #image slot holds the image store hash, the thumbnail itself is inserted over it in the next step
     rc = sheet.max_row
-    if img:
+    if img and not img.Reused: # near-duplicates only keep the hash of the earlier image, so they don't grow the workbook
         eimg = _dump_and_resize_image(img, gid, _IMAGE_HEIGHT)
         sheet.add_image(eimg, f"F{rc}")
     sheet.row_dimensions[rc].height = _pixel_to_point(_IMAGE_HEIGHT) # set all row heights to be the image height
@@ -230,12 +234,38 @@ def prune_old_data() -> str:
     # perform the rename and rollover
     # NF TODO
     if rollover:
+        hashes = [row[5] for row in sheet.iter_rows(min_row=2, max_col=6, values_only=True) if row and row[5]]
         name = _rollover()
         print(f"The prevous ellen.xlsx file has been rolled over. It is available under the filename {name}")
+        _collect_images(hashes)
         return name
 
     return None
 
+def maintenance_pending() -> bool:
+    """ rollovers always complete in a single pass, so there is never maintenance left over """
+    return False
+
+def _collect_images(hashes: List[str]):
+    """ deletes the store images and thumbnails of rows that were rolled over. The rolled over workbook has the thumbnails
+    embedded, and the new ellen.xlsx starts out empty, so nothing references them any more """
+    deleted = libellen_images.delete_unreferenced([str(h) for h in hashes], lambda h: False)
+    thumbs = 0
+    thumb_dir = os.path.join(_CONFIG.SAVE_PATH, "img")
+    wanted = set(h for h in hashes if libellen_images.is_valid_hash(str(h)))
+    try:
+        for name in os.listdir(thumb_dir):
+            if name.split(".")[0] in wanted:
+                try:
+                    os.remove(os.path.join(thumb_dir, name))
+                    thumbs += 1
+                except OSError as e:
+                    print(f"Failed to delete thumbnail {name}: {e}")
+    except FileNotFoundError:
+        pass
+    print(f"Deleted {len(deleted)} images and {thumbs} thumbnails of rolled over rows")
+    return
+
 def _rollover() -> str:
     """ moves the current ellen.xlsx to a rolled over 'Ellen-YYYY-dd-MM.c.xlsx' file.
     Returns the name of the rolled over file
@@ -1,8 +1,13 @@
-import sys, os
-from flask import Flask, session, request, render_template
+import sys, os, time
+_STARTUP_BEGIN = time.perf_counter() # measured as early as possible, before any of the heavy imports
+import socket, threading
+from flask import Flask, session, request, render_template, send_file
 import json
 from lib import libellen
 from lib import libellen_core
+from lib import libellen_images
+from lib import libellen_dedup
+from lib import libellen_stream
 from datetime import datetime, timedelta, timezone
 
 # flask/pyinstaller stuff
@@ -11,13 +16,34 @@ base_dir = '.'
 if hasattr(sys, '_MEIPASS'):
     base_dir = os.path.join(sys._MEIPASS)
 
+# Warn if the server takes longer than this to start accepting requests, IVAR events sent before then are dropped
+# (setup is held to the same budget before release by src/startup_check.py, which the BuildDev workflow runs)
+_STARTUP_BUDGET_SECONDS = 3.0
+# Pause between maintenance passes when a prune ran out of its time budget, so that writers get a turn
+_MAINTENANCE_CONTINUE_SECONDS = 1.0
+# How long the deferred prune waits for the server to start listening before pruning anyway
+_DEFERRED_PRUNE_TIMEOUT_SECONDS = 30.0
+
+# Images are content addressed and never change, so clients may cache them for as long as they like
+_IMAGE_CACHE_SECONDS = 365 * 24 * 60 * 60
+
+# Idle /events/stream connections are sent a keep-alive this often, which is also how dropped connections are noticed
+_STREAM_KEEPALIVE_SECONDS = 15
+# How long an EventSource waits before reconnecting to /events/stream after the connection drops
+_STREAM_RETRY_MS = 3000
+
 last_ran = datetime.now()
+# The single maintenance thread: whether it is running, and whether another pass was asked for since it last started one
+_MAINTENANCE_LOCK = threading.Lock()
+_maintenance_running = False
+_maintenance_requested = False
 app = Flask(__name__,
             static_folder=os.path.join(base_dir, 'static'),
             template_folder=os.path.join(base_dir, 'templates'))
 
-def setup():
-    """ initializes Ellen by grabbing configs and ensuring initial files """
+def setup(defer_prune: bool = False):
+    """ initializes Ellen by grabbing configs and ensuring initial files.
+    If defer_prune is True, the prune is left for start_maintenance to run in the background """
     conf = libellen.read_config()
     if not conf:
         libellen.write_default_config()
@@ -26,32 +52,75 @@ def setup():
             print("Failed to load config.ini, shutting down")
             sys.exit(-1)
     try:
-        libellen.apply_config(conf)
+        libellen.apply_config(conf, prune_now=not defer_prune)
     except AttributeError:
         print("Config file was corrupted. Regenerting a new default config.ini")
         libellen.write_default_config()
         conf = libellen.read_config()
+        libellen.apply_config(conf, prune_now=not defer_prune)
     print("Using the following config settings:")
-    print(conf.__dict__)
+    print(conf.to_dict())
     return
 
-def validate_format(obj) -> bool:
-    """ given a json post, check that its a valid gorilla formatted item """
-    if obj is None:
-        return False
-    if not isinstance(obj, dict):
-        return False
-    if not obj.get("id"):
-        return False
-    common = obj.get("common")
-    if not common or not isinstance(common, dict):
-        return False
-    if not common.get("time") or not common.get("type"):
-        return False
-    imgs = common.get("images")
-    if imgs and not isinstance(imgs, list):
-        return False
-    return True
+def _wait_for_listen(port: int, timeout: float) -> bool:
+    """ polls localhost:port until it accepts connections. Returns False if timeout elapsed first """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def _background_maintenance(port: int = None):
+    """ runs a prune, continuing until the store is within its limits, and runs again for as long as start_maintenance
+    asked for more while it was busy. If port is given, first waits for the server to start listening on it and reports the startup time """
+    global _maintenance_running, _maintenance_requested
+    if port is not None:
+        if _wait_for_listen(port, _DEFERRED_PRUNE_TIMEOUT_SECONDS):
+            elapsed = time.perf_counter() - _STARTUP_BEGIN
+            print(f"Ellen accepting requests {elapsed:.2f}s after start")
+            if elapsed > _STARTUP_BUDGET_SECONDS:
+                print(f"WARNING: startup took longer than the budget of {_STARTUP_BUDGET_SECONDS}s, IVAR events may have been dropped")
+        else:
+            print(f"Server was not listening on port {port} after {_DEFERRED_PRUNE_TIMEOUT_SECONDS}s, pruning anyway")
+    while True:
+        with _MAINTENANCE_LOCK:
+            if not _maintenance_requested:
+                _maintenance_running = False
+                return
+            _maintenance_requested = False
+        try:
+            print("checking for old records in storage file")
+            libellen.run_maintenance()
+        except Exception as e:
+            print(f"Prune failed: {e}")
+        _continue_maintenance()
+
+def _continue_maintenance():
+    """ prune passes are time-boxed. Keeps running further passes, with a pause between them, until the store is within its limits """
+    while libellen.maintenance_pending():
+        time.sleep(_MAINTENANCE_CONTINUE_SECONDS)
+        try:
+            libellen.run_maintenance()
+        except Exception as e:
+            print(f"Prune failed: {e}")
+            return
+    return
+
+def start_maintenance(port: int = None):
+    """ runs the prune on a background thread, so that neither startup nor a config reload has to wait for it.
+    There is only ever one maintenance thread; if it is already running, it is told to do another pass once it is done.
+    At startup, pass the port so that the prune waits until the server is listening """
+    global _maintenance_running, _maintenance_requested
+    with _MAINTENANCE_LOCK:
+        _maintenance_requested = True
+        if _maintenance_running:
+            return
+        _maintenance_running = True
+    threading.Thread(target=_background_maintenance, args=(port,), name="ellen-maintenance", daemon=True).start()
+    return
 
 def validate_management(obj) -> libellen_core.Config:
     """ Given a json post to the Management endpoint, validate its format """
@@ -128,7 +197,8 @@ def validate_management(obj) -> libellen_core.Config:
         config: libellen_core = libellen_core.Config(STORE_FULL_JSON, STORE_IMAGE,
             STORE_IMAGE_KIND, MAX_DB_SIZE, MAX_RECORD_COUNT,
             MAX_KEEP_DAYS, libellen.CONFIG.SAVE_PATH, OUTPUT_DIR, KIND, PORT,
-            TIMEZONE)
+            TIMEZONE, libellen.CONFIG.DEDUP_IMAGES, libellen.CONFIG.DEDUP_THRESHOLD, libellen.CONFIG.DEDUP_WINDOW,
+            libellen.CONFIG.DEBUG_PROFILER, libellen.CONFIG.SQL_PROFILE)
         return config
     except:
         return None
@@ -140,19 +210,19 @@ def save_gorilla():
     """ receives gorilla formatted data, and if valid, saves to the backing store """
     global last_ran
     if (datetime.now() - timedelta(hours=1)) >= last_ran:
-        print("checking for old records in storage file")
-        libellen.prune()
         last_ran = datetime.now()
-    j = request.json
+        start_maintenance() # in the background, so this event isn't held up by the prune
+    j = request.get_json(silent=True)
     res = {}
-    if not validate_format(j):
-        res["error"] = "received post data wasn't a valid Gorilla formatted JSON object"
+    try:
+        event = libellen.decode_event(j) # validates and extracts the event in a single pass
+    except ValueError as e:
+        res["error"] = str(e)
         return res, 400
     try:
-        libellen.receive_json(j)
-        id = j["id"]
+        libellen.receive_event(event, j)
         res = {
-            "id": id
+            "id": event.Id
         }
         return res, 200
     except FileNotFoundError as e:
@@ -165,6 +235,72 @@ def save_gorilla():
         res["error"] = str(e)
         return res, 503
 
+@app.route('/images/<hash>', methods=["GET"])
+def get_image(hash: str):
+    """ serves an image from the content-addressed image store. The hash doubles as a strong ETag """
+    hash = hash.lower()
+    if not libellen_images.is_valid_hash(hash):
+        return {"error": "not a valid image hash"}, 400
+    if hash in request.if_none_match:
+        res = app.response_class(status=304)
+    else:
+        path = libellen_images.find_image(hash)
+        if path is None:
+            return {"error": f"no image with hash {hash}"}, 404
+        res = send_file(os.path.abspath(path), mimetype=libellen_images.guess_mimetype(path)) # uses the server's file wrapper (sendfile) when available
+    res.set_etag(hash)
+    res.cache_control.no_cache = None # send_file may mark the response no-cache, but this content never changes
+    res.cache_control.public = True
+    res.cache_control.max_age = _IMAGE_CACHE_SECONDS
+    return res
+
+@app.route('/events/stream', methods=["GET"])
+def events_stream():
+    """ streams each newly stored event as it is stored, as Server-Sent Events, or with ?format=ndjson, as one json object per line.
+    ?person=id,id and ?type=FACE,... filter the events. A client resumes after the last event id it saw with the Last-Event-ID header or ?after=id """
+    fmt = request.args.get("format", "sse").lower()
+    if fmt not in ("sse", "ndjson"):
+        return {"error": "format must be sse or ndjson"}, 400
+    lastId = request.headers.get("Last-Event-ID") or request.args.get("after")
+    try:
+        lastId = int(lastId) if lastId else None
+    except ValueError:
+        return {"error": "the last event id must be a number"}, 400
+    people = {p.strip() for p in request.args.get("person", "").split(",") if p.strip()}
+    types = {t.strip().upper() for t in request.args.get("type", "").split(",") if t.strip()}
+    if not libellen_stream.subscribe():
+        return {"error": f"too many subscribers, at most {libellen_stream.MAX_SUBSCRIBERS} may be connected"}, 503
+    after, gap = libellen_stream.resume_from(lastId)
+    sse = fmt == "sse"
+    format_event = libellen_stream.format_sse if sse else libellen_stream.format_ndjson
+
+    def generate():
+        nonlocal after
+        # sent straight away, so the headers go out and EventSource.onopen fires without waiting for the first event
+        yield f"retry: {_STREAM_RETRY_MS}\n: connected\n\n" if sse else json.dumps({"connected": True, "after": after}) + "\n"
+        if gap:
+            yield f"event: gap\ndata: {json.dumps(gap)}\n\n" if sse else json.dumps({"gap": gap}) + "\n"
+        while True:
+            try:
+                events = libellen_stream.wait_for(after, _STREAM_KEEPALIVE_SECONDS)
+            except libellen_stream.Lagged as e:
+                # the ring moved past this client, so it is dropped instead of holding anything up. It may reconnect and resume
+                yield f"event: dropped\ndata: {json.dumps({'error': str(e)})}\n\n" if sse else json.dumps({"dropped": str(e)}) + "\n"
+                return
+            if not events:
+                yield ": keep-alive\n\n" if sse else "\n"
+                continue
+            chunk = "".join(format_event(seq, rec) for seq, rec in events if libellen_stream.matches(rec, people, types))
+            after = events[-1][0]
+            if chunk:
+                yield chunk
+
+    res = app.response_class(generate(), mimetype="text/event-stream" if sse else "application/x-ndjson")
+    res.headers["Cache-Control"] = "no-cache"
+    res.headers["X-Accel-Buffering"] = "no" # stops reverse proxies like nginx buffering the stream
+    res.call_on_close(libellen_stream.unsubscribe) # runs even if the client leaves before the first event
+    return res
+
 @app.route('/healthcheck', methods=["GET"])
 def healthcheck():
     return 'Ellen is Running'
@@ -185,7 +321,12 @@ def post_config():
     if not conf:
         res["error"] = "received post data wasn't a valid Management Endpoint formatted JSON object"
         return res, 400
-    libellen.write_custom_config(conf)
+    try:
+        libellen.write_custom_config(conf, prune_now=False)
+    except AttributeError as e:
+        res["error"] = str(e)
+        return res, 400
+    start_maintenance()
     return 'Updated config settings', 200
 
 @app.route("/manage/newconfig", methods=["POST"])
@@ -196,15 +337,67 @@ def regenerate_config():
     except FileNotFoundError:
         print("No pre-existing config.ini found. Continuing.")
     libellen.write_default_config()
-    setup()
+    setup(defer_prune=True)
+    start_maintenance()
     res = "Successfully regenerated new config.ini file"
     return res, 200
 
+@app.route('/manage/dedupstats', methods=["GET"])
+def dedup_stats():
+    """ returns the near-duplicate image counters, showing how much storage dedup has saved """
+    stats = libellen_dedup.get_stats()
+    stats["enabled"] = libellen.CONFIG.DEDUP_IMAGES
+    return stats, 200
+
+@app.route('/manage/migrate', methods=["POST"])
+def start_migration():
+    """ starts a background migration of all stored data between the XLS and SQL stores.
+    Expects a 'direction' of either xls2sql or sql2xls, and optionally 'restart' to ignore saved progress """
+    from lib import libellen_migrate # imported lazily, the migration pulls in both backends
+    obj = request.get_json(silent=True) or request.form
+    direction = str(obj.get("direction", "")).lower()
+    if direction not in (libellen_migrate.DIRECTION_XLS_TO_SQL, libellen_migrate.DIRECTION_SQL_TO_XLS):
+        return {"error": f"direction must be oneof '{libellen_migrate.DIRECTION_XLS_TO_SQL}', '{libellen_migrate.DIRECTION_SQL_TO_XLS}'"}, 400
+    libellen_migrate.set_config(libellen.CONFIG)
+    if str(obj.get("restart", "")).lower() in ("true", "on", "1"):
+        libellen_migrate.clear_checkpoint()
+    if not libellen_migrate.start_migration(direction, libellen._STORE_LOCK):
+        return {"error": "a migration is already running"}, 409
+    return libellen_migrate.get_status(), 202
+
+@app.route('/manage/migrate', methods=["GET"])
+def migration_status():
+    """ returns the progress of the current or last migration """
+    from lib import libellen_migrate
+    return libellen_migrate.get_status(), 200
+
+@app.route('/debug/profile', methods=["GET"])
+def debug_profile():
+    """ samples the stacks of all server threads for ?seconds=N, and returns them as collapsed stacks for a flamegraph,
+    or with ?format=summary, as json samples grouped by Ellen function. Only available when the DEBUG Profiler option is on """
+    if not libellen.CONFIG.DEBUG_PROFILER:
+        return {"error": "the profiler is disabled. Set 'profiler = True' under [DEBUG] in config.ini to enable it"}, 404
+    from lib import libellen_profile # imported lazily, it's only needed while diagnosing
+    try:
+        seconds = float(request.args.get("seconds", "5"))
+    except ValueError:
+        return {"error": "seconds must be a number"}, 400
+    if seconds <= 0 or seconds > libellen_profile.MAX_SECONDS:
+        return {"error": f"seconds must be between 0 and {libellen_profile.MAX_SECONDS}"}, 400
+    result = libellen_profile.profile(seconds)
+    if result is None:
+        return {"error": "a profile is already running"}, 409
+    stacks, by_function, rounds = result
+    if request.args.get("format", "collapsed").lower() == "summary":
+        return libellen_profile.format_summary(by_function, rounds), 200
+    return app.response_class(libellen_profile.format_collapsed(stacks), mimetype="text/plain")
+
 @app.route('/manage/reload', methods=["POST"])
 def relod():
     """ re-reads the config.ini and reloads its settings """
     try:
-        setup()
+        setup(defer_prune=True)
+        start_maintenance()
         return "Successfully reloaded config options"
     except Exception as e:
         return str(e), 500
@@ -212,6 +405,9 @@ def relod():
 # setup will always run, either through invocation via `Flask run` or from direct `main.
 # in case of `Flask run`, server port will be ignored and will always be `5000`. For custom port,
 # call Ellen directly such that the main method runs
-setup()
+# the initial prune is deferred until the server is listening, so that startup is not held up by it
+setup(defer_prune=True)
+print(f"Ellen setup completed in {time.perf_counter() - _STARTUP_BEGIN:.2f}s")
+start_maintenance(libellen.CONFIG.PORT)
 if __name__ == "__main__":
     app.run(port=libellen.CONFIG.PORT)
\ No newline at end of file
@@ -0,0 +1,57 @@
+import sys, os, time
+import configparser
+import shutil
+import tempfile
+
+## Startup regression check
+# Imports the server the way it is started in production, with the SQL backing store, in a scratch directory,
+# and fails if the XLS/imaging dependencies were imported or if setup took longer than the server's startup budget.
+# Run from the repository root with `python src/startup_check.py`, as the BuildDev workflow does.
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+_HEAVY_MODULES = ("openpyxl", "PIL") # only needed by the XLS store and image resizing
+
+def _write_sql_config(path: str):
+    conf = configparser.ConfigParser()
+    conf["MAINTENANCE"] = {"MaxKeepDays": "30", "MaxRecordCount": "10000", "MaxDbSize": "100"}
+    conf["SAVE"] = {
+        "StoreImageKind": "FACE",
+        "StoreImage": "True",
+        "StoreFullJson": "False",
+        "DataDirectory": "./data",
+        "OutputDirectory": "./",
+        "Kind": "SQL",
+        "Timezone": "Local",
+    }
+    conf["SERVER"] = {"Port": "5000"}
+    with open(path, 'w') as f:
+        conf.write(f)
+    return
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="ellen-startup-")
+    cwd = os.getcwd()
+    failures = []
+    try:
+        _write_sql_config(os.path.join(workdir, "config.ini"))
+        os.chdir(workdir)
+        sys.path.insert(0, _SRC_DIR)
+        begin = time.perf_counter()
+        import server
+        elapsed = time.perf_counter() - begin
+        print(f"server imported and set up in {elapsed:.2f}s (budget {server._STARTUP_BUDGET_SECONDS}s)")
+        if elapsed > server._STARTUP_BUDGET_SECONDS:
+            failures.append(f"setup took {elapsed:.2f}s, over the budget of {server._STARTUP_BUDGET_SECONDS}s")
+        for mod in _HEAVY_MODULES:
+            if mod in sys.modules:
+                failures.append(f"{mod} was imported during startup with Kind = SQL")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True) # the sqlite file may still be open on Windows
+    for f in failures:
+        print(f"FAILED: {f}")
+    if not failures:
+        print("startup check passed")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())